@@ -1,10 +1,23 @@
 import os
 import uuid
 import re
-from datetime import datetime, date, time as dtime
+import json
+import base64
+import bisect
+import threading
+import hashlib
+from types import SimpleNamespace
+from collections import deque
+from time import monotonic
+from datetime import datetime, date, time as dtime, timedelta
+import click
+import numpy as np
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask import Flask, render_template, redirect, url_for, flash, request, abort, jsonify
+from flask import (
+    Flask, render_template, redirect, url_for, flash, request, abort, jsonify, Response, stream_with_context,
+    g, has_request_context
+)
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
     LoginManager, UserMixin, login_user, login_required, logout_user, current_user
@@ -19,6 +32,8 @@ from wtforms.validators import (
     DataRequired, Length, NumberRange, EqualTo, Optional, URL, ValidationError, Regexp
 )
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import selectinload
 
 # =========================================
 # App / Config
@@ -57,15 +72,41 @@ app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024  # 8MB
 OPEN_HOUR = 13
 CLOSE_HOUR = 22
 STEP_MINUTES = int(os.environ.get("STEP_MINUTES", "30"))
+# آخر موعد يبدأ قبل الإغلاق بهذه المدة (دقائق): الإغلاق 10:00 ← آخر موعد 9:30
+LAST_START_LEAD = int(os.environ.get("LAST_START_LEAD", "30"))
+# ساعات كل يوم (env): BUSINESS_HOURS="*=13:00-22:00;3=14:00-23:00" (0=الاثنين ... 6=الأحد)
+BUSINESS_HOURS = os.environ.get("BUSINESS_HOURS", f"*={OPEN_HOUR:02d}:00-{CLOSE_HOUR:02d}:00")
 CURRENCY_LABEL = os.environ.get("CURRENCY_LABEL", "ريال")
 
 # Closed days (env): CLOSED_WEEKDAYS="5,6" / CLOSED_DATES="2025-08-15,2025-08-20"
 # Closed days (env): CLOSED_WEEKDAYS="4" (4=الجمعة) / CLOSED_DATES="2025-08-15,2025-08-20"
+# CLOSED_DATES تقبل أيضاً فترات عطل: "2025-03-30..2025-04-03"
 CLOSED_WEEKDAYS = set(
     int(x) for x in os.environ.get("CLOSED_WEEKDAYS", "4").split(",") if x.strip().isdigit()
 )  # الافتراضي: الجمعة
 CLOSED_DATES = set(s.strip() for s in os.environ.get("CLOSED_DATES", "").split(",") if s.strip())
 
+# Availability index: الحالات التي تشغل الموعد + مدة صلاحية اليوم المحمّل في الذاكرة (ثواني)
+ACTIVE_STATUSES = ("pending", "approved")
+AVAILABILITY_TTL = int(os.environ.get("AVAILABILITY_TTL", "60"))
+# مدة الحجز المؤقت للموعد أثناء تعبئة نموذج الحجز (ثواني)
+HOLD_TTL = int(os.environ.get("HOLD_TTL", "180"))
+# بث التوفر (SSE): نبضة كل SSE_HEARTBEAT ثانية، ويُغلق الاتصال بعد SSE_MAX_SECONDS ليعيد المتصفح الاتصال
+SSE_HEARTBEAT = int(os.environ.get("SSE_HEARTBEAT", "15"))
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", "300"))
+# كل بث يشغل خيطاً من خيوط العامل طوال مدته؛ بعد هذا العدد (لكل عملية) يُرد 503 ويعود المتصفح للاستطلاع
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "4"))
+
+# أسماء الأيام (بترتيب weekday) والأشهر للعرض، وبداية أسبوع تقويم الإدارة (5=السبت)
+WEEKDAY_NAMES = ["الاثنين", "الثلاثاء", "الأربعاء", "الخميس", "الجمعة", "السبت", "الأحد"]
+MONTH_NAMES = ["يناير", "فبراير", "مارس", "أبريل", "مايو", "يونيو",
+               "يوليو", "أغسطس", "سبتمبر", "أكتوبر", "نوفمبر", "ديسمبر"]
+CALENDAR_WEEK_START = 5
+
+# الأرشفة: الحجوزات الأقدم من ARCHIVE_AFTER_DAYS يوماً تُنقل إلى booking_archive على دفعات
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", "500"))
+
 # Video helpers
 ALLOWED_VIDEO_EXTS = {"mp4"}
 VIDEO_FOLDER = os.path.join(app.static_folder, "uploads", "videos")
@@ -117,6 +158,10 @@ def validate_saudi_phone(phone):
 # Jinja filters
 # =========================================
 def currency(value):
+    if isinstance(value, (Booking, ArchivedBooking)):
+        value = booking_price(value)  # سعر الحجز وقت إنشائه لا سعر الخدمة اليوم
+        if value is None:
+            return "-"
     try:
         return f"{float(value):.2f} {CURRENCY_LABEL}"
     except Exception:
@@ -127,53 +172,378 @@ app.jinja_env.filters["currency"] = currency
 # =========================================
 # Helpers
 # =========================================
+def _minutes(at) -> int:
+    return at.hour * 60 + at.minute
+
+def _hhmm(minutes: int) -> str:
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+def _parse_hhmm(value: str) -> int:
+    h, m = value.strip().split(":")
+    return int(h) * 60 + int(m)
+
+class BusinessCalendar:
+    """تقويم العمل مُجمَّعاً مسبقاً.
+
+    يُبنى مرة واحدة عند بدء التشغيل: جدول مواعيد لكل يوم من أيام الأسبوع،
+    وقناع bitset لكل يوم على الشبكة الموحدة (اتحاد مواعيد كل الأيام)،
+    والعطل كمجموعة تواريخ. "هل اليوم مفتوح" و"مواعيد اليوم" بحث O(1).
+    """
+
+    def __init__(self, hours: dict, holidays=(), step: int = STEP_MINUTES, lead: int = LAST_START_LEAD):
+        self.step = step
+        self.lead = lead
+        self.hours = {wd: hours[wd] for wd in range(7) if wd in hours}
+        self.holidays = frozenset(holidays)
+
+        weekly = []
+        for wd in range(7):
+            if wd in self.hours:
+                open_m, close_m = self.hours[wd]
+                weekly.append(tuple(range(open_m, close_m - lead + 1, step)))
+            else:
+                weekly.append(())
+        self.grid_minutes = sorted(set().union(*weekly))
+        self.grid = [_hhmm(m) for m in self.grid_minutes]
+        position = {m: i for i, m in enumerate(self.grid_minutes)}
+        self.weekly_slots = [tuple(_hhmm(m) for m in mins) for mins in weekly]
+        self.weekly_masks = [sum(1 << position[m] for m in mins) for mins in weekly]
+
+    @classmethod
+    def from_env(cls):
+        hours = {}
+        for entry in BUSINESS_HOURS.split(";"):
+            if "=" not in entry:
+                continue
+            days, span = entry.split("=", 1)
+            open_s, close_s = span.split("-")
+            targets = range(7) if days.strip() == "*" else [int(x) for x in days.split(",") if x.strip().isdigit()]
+            for wd in targets:
+                hours[wd] = (_parse_hhmm(open_s), _parse_hhmm(close_s))
+        # الجمعة مغلقة دائماً إضافة إلى CLOSED_WEEKDAYS
+        for wd in CLOSED_WEEKDAYS | {4}:
+            hours.pop(wd, None)
+
+        holidays = set()
+        for token in CLOSED_DATES:
+            first, _, last = token.partition("..")
+            try:
+                first = date.fromisoformat(first.strip())
+                last = date.fromisoformat(last.strip()) if last else first
+            except ValueError:
+                continue
+            holidays.update(first + timedelta(days=n) for n in range((last - first).days + 1))
+        return cls(hours, holidays)
+
+    def is_open(self, d: date) -> bool:
+        return bool(self.weekly_masks[d.weekday()]) and d not in self.holidays
+
+    def slots_for(self, d: date) -> tuple:
+        return self.weekly_slots[d.weekday()] if self.is_open(d) else ()
+
+    def open_mask(self, d: date) -> int:
+        """bitset المواعيد المفتوحة في هذا اليوم على الشبكة الموحدة"""
+        return self.weekly_masks[d.weekday()] if self.is_open(d) else 0
+
+    def hours_for(self, d: date):
+        """(الافتتاح، الإغلاق، آخر موعد) بصيغة HH:MM أو None لليوم المغلق"""
+        if not self.is_open(d):
+            return None
+        open_m, close_m = self.hours[d.weekday()]
+        return _hhmm(open_m), _hhmm(close_m), _hhmm(close_m - self.lead)
+
+    def last_starts(self) -> list[str]:
+        """أوقات آخر موعد المختلفة عبر أيام الأسبوع المفتوحة (للعرض في النموذج)"""
+        return sorted({_hhmm(close_m - self.lead) for _, close_m in self.hours.values()})
+
+    def within_hours(self, dt: datetime) -> bool:
+        hours = self.hours.get(dt.weekday())
+        return bool(hours) and hours[0] <= _minutes(dt) <= hours[1] - self.lead
+
+business_calendar = BusinessCalendar.from_env()
+app.jinja_env.globals["business_calendar"] = business_calendar
+
 def time_slots(step_minutes: int | None = None):
-    if step_minutes is None:
-        step_minutes = STEP_MINUTES
-    slots = []
-    for h in range(OPEN_HOUR, CLOSE_HOUR):
-        m = 0
-        while m < 60:
-            if h == CLOSE_HOUR - 1 and m > 30:
-                break
-            slots.append(f"{h:02d}:{m:02d}")
-            m += step_minutes
-    return slots
+    """شبكة المواعيد الموحدة لكل الأيام من تقويم العمل"""
+    if step_minutes is None or step_minutes == business_calendar.step:
+        return list(business_calendar.grid)
+    return BusinessCalendar(business_calendar.hours, step=step_minutes).grid
 
 def compose_datetime(d: date, t_str: str) -> datetime:
     h, m = map(int, t_str.split(":"))
     return datetime.combine(d, dtime(hour=h, minute=m))
 
+def day_bounds(d: date):
+    """حدود اليوم كنطاق نصف مفتوح [بداية اليوم، بداية اليوم التالي) حتى يُستخدم فهرس appointment_at"""
+    start = datetime.combine(d, dtime.min)
+    return start, start + timedelta(days=1)
+
 def within_business_hours(dt: datetime) -> bool:
-    return (OPEN_HOUR <= dt.hour < CLOSE_HOUR) and not (
-        dt.hour == CLOSE_HOUR - 1 and dt.minute > 30
-    )
+    return business_calendar.within_hours(dt)
 
 def is_closed_day(d: date) -> bool:
-    """التحقق من أيام الإغلاق"""
-    
-    # 1. التحقق من التواريخ المحددة يدوياً
-    if str(d) in CLOSED_DATES:
-        return True
-    
-    # 2. التحقق من أيام الأسبوع المغلقة
-    if d.weekday() in CLOSED_WEEKDAYS:
+    """التحقق من أيام الإغلاق (أيام الأسبوع المغلقة، الجمعة، العطل)"""
+    return not business_calendar.is_open(d)
+
+
+def is_conflicting(service_id: int, when_dt: datetime, viewer_id: int | None = None) -> bool:
+    """هل الموعد (مع مدة الخدمة) يتجاوز سعة الموارد المطلوبة للخدمة؟
+
+    فحص سريع من الذاكرة لرسالة واضحة (يشمل الحجوزات المؤقتة لغير viewer_id)؛
+    الضمان الفعلي هو قيد slot_reservation في القاعدة.
+    """
+    return not slot_index.fits(service_id, when_dt, viewer_id=viewer_id)
+
+def _reservation_cells(booking) -> list[tuple[datetime, datetime]]:
+    """خلايا الشبكة التي يغطيها الحجز طوال مدة خدمته"""
+    slot_index.sync(exact=True)  # مسار الكتابة: المدد والسعات كما في القاعدة الآن
+    step = timedelta(minutes=business_calendar.step)
+    at = booking.appointment_at
+    end = at + timedelta(minutes=slot_index.duration(booking.service_id))
+    cells = []
+    while at < end:
+        cells.append((at, min(at + step, end)))
+        at += step
+    return cells
+
+def _claim_cells(service_id: int, cells, attempts: int = 3, **owner) -> bool:
+    """حجز وحدة حرة لكل خلية ولكل مورد تحتاجه الخدمة، بإدخال واحد داخل savepoint.
+
+    الوحدة تُختار لكل خلية على حدة (لا يلزم أن تبقى نفس الوحدة طوال المدة) فيطابق
+    فحص القاعدة منطق fits(): عدد الحجوزات في كل خلية <= السعة. إذا سبقنا طلب متزامن
+    إلى وحدة رفض القيد الفريد الإدخال فنعيد القراءة والمحاولة.
+    """
+    needs = slot_index.requirements(service_id)
+    if not cells:
         return True
-    
-    # 3. منع الجمعة (weekday = 4 للجمعة)
-    if d.weekday() == 4:  # الجمعة
-        return True
-    
+    for _ in range(attempts):
+        taken, stale, now = {}, [], datetime.utcnow()
+        existing = db.session.execute(
+            db.select(SlotReservation.id, SlotReservation.lane, SlotReservation.unit,
+                      SlotReservation.slot_at, SlotReservation.slot_end, SlotHold.expires_at)
+            .outerjoin(SlotHold, SlotReservation.hold_id == SlotHold.id)
+            .where(SlotReservation.lane.in_(list(needs)),
+                   SlotReservation.slot_at < cells[-1][1], SlotReservation.slot_end > cells[0][0])
+        )
+        for reservation_id, lane, unit, at, end, expires in existing:
+            if expires is not None and expires <= now:
+                stale.append(reservation_id)  # خلايا حجز مؤقت منتهٍ تُحرَّر مع هذا الإدخال
+                continue
+            for cell_at, cell_end in cells:
+                if at < cell_end and end > cell_at:
+                    taken.setdefault((lane, cell_at), set()).add(unit)
+
+        rows = []
+        for lane, quantity in needs.items():
+            units = range(slot_index.lane_capacity(lane))
+            for at, end in cells:
+                free = [u for u in units if u not in taken.get((lane, at), ())][:quantity]
+                if len(free) < quantity:
+                    return False
+                rows += [dict(owner, lane=lane, unit=u, slot_at=at, slot_end=end) for u in free]
+        try:
+            with db.session.begin_nested():
+                if stale:
+                    db.session.execute(db.delete(SlotReservation).where(SlotReservation.id.in_(stale)))
+                db.session.execute(db.insert(SlotReservation), rows)
+            return True
+        except IntegrityError:
+            continue
     return False
 
+def reserve_slot(booking) -> bool:
+    """حجز خلايا الموعد لكل مورد تحتاجه الخدمة (يجب أن يكون للحجز id).
+
+    يعيد False إذا لم تتسع السعة، وعندها على المستدعي عمل rollback.
+    """
+    return _claim_cells(booking.service_id, _reservation_cells(booking), booking_id=booking.id)
+
+def release_slot(booking):
+    db.session.execute(db.delete(SlotReservation).where(SlotReservation.booking_id == booking.id))
+
+def set_booking_status(booking, status: str) -> bool:
+    """تغيير حالة الحجز مع حجز أو تحرير خلايا موعده؛ False إذا لم يعد الموعد متاحاً"""
+    was_active = booking.status in ACTIVE_STATUSES
+    booking.status = status
+    if status in ACTIVE_STATUSES and not was_active:
+        return reserve_slot(booking)
+    if was_active and status not in ACTIVE_STATUSES:
+        release_slot(booking)
+    return True
+
+def rebuild_slot_reservations() -> tuple[int, list]:
+    """إعادة حجز خلايا الحجوزات النشطة القادمة؛ يعيد (عدد ما حُجز، معرّفات المتعارضة)"""
+    now = datetime.now()
+    upcoming = db.select(Booking.id).where(Booking.appointment_at >= now)
+    db.session.execute(db.delete(SlotReservation).where(SlotReservation.booking_id.in_(upcoming)))
+    bookings = db.session.scalars(
+        db.select(Booking).where(Booking.appointment_at >= now, Booking.status.in_(ACTIVE_STATUSES))
+        .order_by(Booking.appointment_at, Booking.id)
+    ).all()
+    slot_index.invalidate()
+    failed = []
+    for b in bookings:
+        savepoint = db.session.begin_nested()
+        if reserve_slot(b):
+            savepoint.commit()
+        else:
+            savepoint.rollback()
+            failed.append(b.id)
+    db.session.commit()
+    return len(bookings) - len(failed), failed
+
+def ensure_slot_holds() -> bool:
+    """ترقية slot_reservation القديم (booking_id إلزامي، بلا hold_id) لاستيعاب الحجوزات المؤقتة،
+    أو تعبئته إن أُنشئ فارغاً لقاعدة فيها حجوزات قادمة.
+
+    الجدول مشتق من الحجوزات، فيُعاد إنشاؤه ثم تُعاد تعبئته؛ True إذا أُعيد بناؤه الآن.
+    """
+    columns = {c["name"] for c in db.inspect(db.engine).get_columns("slot_reservation")}
+    if "hold_id" not in columns:
+        SlotReservation.__table__.drop(db.engine)
+        db.create_all()
+    elif db.session.scalar(db.select(SlotReservation.id).limit(1)) is not None or db.session.scalar(
+        db.select(Booking.id).where(Booking.appointment_at >= datetime.now(), Booking.status.in_(ACTIVE_STATUSES)).limit(1)
+    ) is None:
+        return False
+    rebuild_slot_reservations()
+    return True
+
+# ===== Keyset pagination =====
+class KeysetPage:
+    """صفحة keyset: items ومؤشرا الصفحة التالية/السابقة (None إذا لا توجد)"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+def _encode_cursor(values) -> str:
+    raw = json.dumps([{"dt": v.isoformat()} if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str, order) -> list:
+    """قيم المؤشر لأعمدة order؛ 400 إذا لم يكن قائمة قيم بسيطة أو {"dt": ...} بنوع كل عمود"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(order):
+            raise ValueError(cursor)
+        decoded = []
+        for (col, _), value in zip(order, values):
+            if isinstance(value, dict):
+                if set(value) != {"dt"} or not isinstance(value["dt"], str):
+                    raise ValueError(cursor)
+                value = datetime.fromisoformat(value["dt"])
+            if not isinstance(value, col.type.python_type):
+                raise ValueError(cursor)
+            decoded.append(value)
+        return decoded
+    except (ValueError, TypeError, NotImplementedError):
+        abort(400)
+
+def keyset_date(col):
+    """عمود تاريخ قابل للفراغ كمفتاح ترتيب keyset: الفارغ يُعامل كأقدم تاريخ فلا يسقط من الصفحات"""
+    return db.func.coalesce(col, db.literal(datetime(1970, 1, 1), db.DateTime))
+
+def _keyset_condition(order, values, backwards: bool):
+    """(a, b, id) بعد/قبل قيم المؤشر حسب اتجاه كل عمود"""
+    forward = [(direction == "asc") != backwards for _, direction in order]
+    if len(set(forward)) == 1:
+        # اتجاه واحد: مقارنة صفوف (row value) يستخدمها فهرس الترتيب مباشرة
+        left = db.tuple_(*(col for col, _ in order))
+        right = db.tuple_(*(db.literal(v, col.type) for (col, _), v in zip(order, values)))
+        return left > right if forward[0] else left < right
+    conditions = []
+    for i, ((col, _), value) in enumerate(zip(order, values)):
+        equal = [c == v for (c, _), v in zip(order[:i], values[:i])]
+        conditions.append(db.and_(*equal, col > value if forward[i] else col < value))
+    return db.or_(*conditions)
+
+def keyset_page(stmt, order, after: str | None = None, before: str | None = None, per_page: int = 20) -> KeysetPage:
+    """صفحة من stmt بالترتيب order = [(عمود، "asc"|"desc"), ...] وآخر عمود فريد (id).
+
+    تبدأ بعد المؤشر after أو تنتهي قبل before بشرط على أعمدة الترتيب بدل OFFSET،
+    فالصفحة العميقة بكلفة الأولى. أعمدة الترتيب يجب ألا تكون NULL (keyset_date للتواريخ الفارغة)،
+    والمؤشر غير الصالح يعطي 400.
+    إن اختار stmt أكثر من عمود كانت العناصر صفوفاً بأعمدته بدل الكائن وحده.
+    """
+    width = len(stmt.column_descriptions)
+    cursor = _decode_cursor(before or after, order) if before or after else None
+    backwards = bool(before)
+    query = stmt
+    if cursor is not None:
+        query = query.where(_keyset_condition(order, cursor, backwards))
+    query = query.add_columns(*(col for col, _ in order)).order_by(
+        *(col.asc() if (direction == "asc") != backwards else col.desc() for col, direction in order)
+    ).limit(per_page + 1)
+    rows = db.session.execute(query).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        if not rows:
+            return keyset_page(stmt, order, per_page=per_page)
+        rows.reverse()
+    has_next = True if backwards else more
+    has_prev = more if backwards else cursor is not None
+    if not rows:
+        # بعد آخر صف (حُذف مثلاً): الرجوع يعيد الصفحة الأخيرة
+        return KeysetPage([], prev_cursor=after if cursor is not None else None)
+    return KeysetPage(
+        [row[0] if width == 1 else tuple(row[:width]) for row in rows],
+        next_cursor=_encode_cursor(rows[-1][width:]) if has_next else None,
+        prev_cursor=_encode_cursor(rows[0][width:]) if has_prev else None,
+    )
 
-def is_conflicting(service_id: int, when_dt: datetime) -> bool:
-    q = db.select(Booking).where(
-        Booking.service_id == service_id,
-        Booking.appointment_at == when_dt,
-        Booking.status.in_(["pending", "approved"]),
+@app.template_global()
+def keyset_url(**cursor):
+    """رابط الصفحة الحالية بمؤشر جديد (after أو before) مع الإبقاء على بقية المعاملات"""
+    args = {k: v for k, v in request.args.items() if k not in ("after", "before")}
+    args.update((k, v) for k, v in cursor.items() if v)
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+def booking_rows(include_archive: bool = False):
+    """أعمدة الحجوزات للتقارير كـ subquery: الجدول الحي فقط، أو مع الأرشيف (UNION ALL)"""
+    live = db.select(Booking.id, Booking.user_id, Booking.service_id, Booking.appointment_at, Booking.status, Booking.price)
+    if not include_archive:
+        return live.subquery("bookings")
+    archived = db.select(
+        ArchivedBooking.id, ArchivedBooking.user_id, ArchivedBooking.service_id,
+        ArchivedBooking.appointment_at, ArchivedBooking.status, ArchivedBooking.price,
     )
-    return db.session.scalar(q) is not None
+    return db.union_all(live, archived).subquery("bookings")
+
+def booking_day_summary(first: date, last: date, include_archive: bool = False) -> dict:
+    """ملخص الحجوزات لكل يوم في [first, last) باستعلام GROUP BY واحد (يوم، حالة، خدمة).
+
+    {يوم: {"total": n, "statuses": {حالة: n}, "services": {service_id: n}}}
+    """
+    rows_q = booking_rows(include_archive)
+    day = db.func.date(rows_q.c.appointment_at).label("day")
+    rows = db.session.execute(
+        db.select(day, rows_q.c.status, rows_q.c.service_id, db.func.count(rows_q.c.id))
+        .where(rows_q.c.appointment_at >= day_bounds(first)[0], rows_q.c.appointment_at < day_bounds(last)[0])
+        .group_by(day, rows_q.c.status, rows_q.c.service_id)
+    )
+    summary = {}
+    for d, status, service_id, n in rows:
+        if not isinstance(d, date):
+            d = date.fromisoformat(d)  # SQLite تعيد date() كنص
+        cell = summary.setdefault(d, {"total": 0, "statuses": {}, "services": {}})
+        cell["total"] += n
+        cell["statuses"][status] = cell["statuses"].get(status, 0) + n
+        cell["services"][service_id] = cell["services"].get(service_id, 0) + n
+    return summary
+
+def calendar_range(view: str, anchor: date) -> tuple[date, date]:
+    """أيام شبكة التقويم [first, last) لأسبوع أو شهر anchor، مكتملة لأسابيع تبدأ بالسبت"""
+    if view == "month":
+        start = anchor.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    else:
+        start, end = anchor, anchor + timedelta(days=1)
+    first = start - timedelta(days=(start.weekday() - CALENDAR_WEEK_START) % 7)
+    last = end + timedelta(days=(CALENDAR_WEEK_START - end.weekday()) % 7)
+    return first, last
 
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -281,6 +651,9 @@ class User(db.Model, UserMixin):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime, nullable=True)
     notes = db.Column(db.Text, nullable=True)  # ملاحظات إدارية
+    # عدّادات مخزّنة (الحي + الأرشيف) تُحدَّث مع كل تغيير على حجوزاته، انظر refresh_user_activity
+    bookings_count = db.Column(db.Integer, nullable=False, default=0, server_default="0", index=True)
+    last_booking_at = db.Column(db.DateTime, nullable=True, index=True)
     
     def set_password(self, raw): 
         self.password_hash = generate_password_hash(raw)
@@ -290,9 +663,7 @@ class User(db.Model, UserMixin):
     
     def get_bookings_count(self):
         """عدد الحجوزات"""
-        return db.session.scalar(
-            db.select(db.func.count(Booking.id)).where(Booking.user_id == self.id)
-        ) or 0
+        return self.bookings_count or 0
     
     def get_last_booking(self):
         """آخر حجز"""
@@ -336,6 +707,27 @@ class Service(db.Model):
     
     # حقل واحد للتقسيط
     installment_available = db.Column(db.Boolean, default=False)  # إمكانية التقسيط
+    # ترتيب الصفحة الرئيسية: حجوزات حديثة موزونة بتضاؤل زمني، يحسبها refresh-popularity دورياً
+    popularity = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    __table_args__ = (db.Index("ix_service_active_popularity", "active", "popularity"),)
+
+RESOURCE_KINDS = {"bay": "غرفة عمل", "technician": "فنّي"}
+
+class Resource(db.Model):
+    """مورد تشغيلي يحدد السعة: غرفة عمل (bay) أو فنّي (technician)"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    kind = db.Column(db.String(20), nullable=False, default="bay")
+    active = db.Column(db.Boolean, default=True)
+
+class ServiceRequirement(db.Model):
+    """ما تحتاجه الخدمة من كل نوع مورد طوال مدتها (مثلاً: تظليل = غرفة + فنّي)"""
+    __tablename__ = "service_requirement"
+    id = db.Column(db.Integer, primary_key=True)
+    service_id = db.Column(db.Integer, db.ForeignKey("service.id"), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    service = db.relationship("Service", backref="requirements")
 
 class Offer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -349,15 +741,60 @@ class Offer(db.Model):
 
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
     service_id = db.Column(db.Integer, db.ForeignKey("service.id"), nullable=False)
     appointment_at = db.Column(db.DateTime, nullable=False, index=True)
     status = db.Column(db.String(20), nullable=False, default="pending")
     notes = db.Column(db.Text, nullable=True)
     car_info_id = db.Column(db.Integer, db.ForeignKey("car_info.id"), nullable=True)
+    price = db.Column(db.Numeric(10,2), nullable=True)  # سعر الخدمة وقت الحجز
     user = db.relationship("User")
     service = db.relationship("Service")
     car_info = db.relationship("CarInfo")
+    reservations = db.relationship("SlotReservation", cascade="all, delete-orphan", backref="booking")
+
+class SlotReservation(db.Model):
+    """خلية محجوزة على شبكة المواعيد: (مسار، وحدة، بداية الخلية) لحجز أو لحجز مؤقت.
+
+    القيد الفريد يجعل القاعدة نفسها تمنع حجز نفس الوحدة في نفس الخلية مرتين،
+    وعلى PostgreSQL يُضاف قيد استبعاد على tsrange(slot_at, slot_end) يمنع أي تداخل.
+    """
+    __tablename__ = "slot_reservation"
+    id = db.Column(db.Integer, primary_key=True)
+    booking_id = db.Column(db.Integer, db.ForeignKey("booking.id", ondelete="CASCADE"), nullable=True, index=True)
+    hold_id = db.Column(db.Integer, db.ForeignKey("slot_hold.id", ondelete="CASCADE"), nullable=True, index=True)
+    lane = db.Column(db.String(40), nullable=False)
+    unit = db.Column(db.Integer, nullable=False, default=0)
+    slot_at = db.Column(db.DateTime, nullable=False)
+    slot_end = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.UniqueConstraint("lane", "unit", "slot_at", name="uq_slot_reservation_cell"),)
+
+db.event.listen(
+    SlotReservation.__table__,
+    "after_create",
+    db.DDL(
+        "CREATE EXTENSION IF NOT EXISTS btree_gist; "
+        "ALTER TABLE slot_reservation ADD CONSTRAINT ex_slot_reservation_overlap "
+        "EXCLUDE USING gist (lane WITH =, unit WITH =, tsrange(slot_at, slot_end) WITH &&)"
+    ).execute_if(dialect="postgresql"),
+)
+
+class SlotHold(db.Model):
+    """حجز مؤقت لموعد (واحد لكل مستخدم) أثناء تعبئة النموذج؛ خلاياه في slot_reservation"""
+    __tablename__ = "slot_hold"
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), nullable=False, unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False, unique=True)
+    service_id = db.Column(db.Integer, db.ForeignKey("service.id", ondelete="CASCADE"), nullable=False)
+    appointment_at = db.Column(db.DateTime, nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class CatalogVersion(db.Model):
+    """رقم إصدار بيانات السعة (مدد الخدمات، الموارد، المتطلبات)؛ يزيد في نفس المعاملة
+    مع كل تعديل عليها فيعرف كل عامل وأمر CLI أن نسخته في الذاكرة قديمة"""
+    __tablename__ = "catalog_version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
 
 class ContactInfo(db.Model):
     __tablename__ = "contact_info"
@@ -396,6 +833,9 @@ class Video(db.Model):
     sort = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# ترتيب قوائم الفيديو (keyset): الأصغر sort أولاً ثم الأحدث؛ sort و created_at قد يكونان فارغين
+VIDEO_ORDER = [(db.func.coalesce(Video.sort, 0), "asc"), (keyset_date(Video.created_at), "desc"), (Video.id, "desc")]
+
 # ===== إضافة جدول معلومات السيارة =====
 class CarInfo(db.Model):
     __tablename__ = "car_info"
@@ -421,6 +861,72 @@ class CarInfo(db.Model):
 # car_info_id = db.Column(db.Integer, db.ForeignKey("car_info.id"), nullable=True)
 # car_info = db.relationship("CarInfo")
 
+# ===== الأرشيف: حجوزات قديمة خارج نافذة العمل =====
+class ArchivedCarInfo(db.Model):
+    """نسخة CarInfo لحجز مؤرشف (بنفس id الأصلي)"""
+    __tablename__ = "car_info_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    brand = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(100), nullable=False)
+    year = db.Column(db.Integer, nullable=True)
+    color = db.Column(db.String(30), nullable=True)
+    plate_number = db.Column(db.String(20), nullable=True)
+    notes = db.Column(db.Text, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    created_at = db.Column(db.DateTime)
+
+class ArchivedBooking(db.Model):
+    """حجز نُقل من booking بعد تجاوزه ARCHIVE_AFTER_DAYS (بنفس id الأصلي)"""
+    __tablename__ = "booking_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    service_id = db.Column(db.Integer, db.ForeignKey("service.id"), nullable=False)
+    appointment_at = db.Column(db.DateTime, nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False)
+    notes = db.Column(db.Text, nullable=True)
+    car_info_id = db.Column(db.Integer, db.ForeignKey("car_info_archive.id"), nullable=True)
+    price = db.Column(db.Numeric(10,2), nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user = db.relationship("User")
+    service = db.relationship("Service")
+    car_info = db.relationship("ArchivedCarInfo")
+
+# ===== كلمات البحث المطبّعة للعملاء =====
+class UserSearchTerm(db.Model):
+    """كلمة مطبّعة من اسم العميل أو صيغة من رقمه (انظر user_search_terms).
+
+    المفتاح (term, user_id) يخدم البحث بالبادئة مباشرة، وعلى PostgreSQL يُضاف فهرس
+    text_pattern_ops وفهرس trigram إن توفر pg_trgm (ensure_user_search).
+    """
+    __tablename__ = "user_search_term"
+    term = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True, index=True)
+
+# ===== تجميعات التقارير =====
+class BookingRollup(db.Model):
+    """عدد الحجوزات وإيرادها ودقائقها لكل (يوم، خدمة، حالة)، شاملة الأرشيف.
+
+    يُعاد حساب أيام الحجوزات المتغيّرة في نفس المعاملة (refresh_rollups)، وتقرأ منه التقارير
+    بدل المرور على كل الحجوزات. service_id بلا مفتاح أجنبي ليبقى التاريخ بعد حذف الخدمة.
+    """
+    __tablename__ = "booking_rollup"
+    day = db.Column(db.Date, primary_key=True)
+    service_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+
+# ===== سجل أسعار الخدمات =====
+class ServicePrice(db.Model):
+    """سعر الخدمة الساري من effective_from حتى السجل التالي لنفس الخدمة"""
+    __tablename__ = "service_price"
+    id = db.Column(db.Integer, primary_key=True)
+    service_id = db.Column(db.Integer, db.ForeignKey("service.id", ondelete="CASCADE"), nullable=False)
+    price = db.Column(db.Numeric(10,2), nullable=False)
+    effective_from = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    __table_args__ = (db.Index("ix_service_price_service_from", "service_id", "effective_from"),)
+
 # ===== قائمة السيارات الشائعة في السعودية =====
 CAR_BRANDS = {
     "Toyota": [
@@ -516,6 +1022,9 @@ CAR_BRANDS = {
     ]
 }
 
+# نسخة الكتالوج: تتغير فقط مع تغيّر CAR_BRANDS، فيُخزّن المتصفح /api/car-catalog?v=... للأبد
+CAR_CATALOG_VERSION = hashlib.sha1(json.dumps(CAR_BRANDS, ensure_ascii=False, sort_keys=True).encode()).hexdigest()[:10]
+
 # ===== ألوان السيارات الشائعة =====
 CAR_COLORS = [
     "أبيض", "أسود", "فضي", "رمادي", "أحمر", "أزرق", "بني", "ذهبي",
@@ -558,6 +1067,1426 @@ class CarBookingForm(FlaskForm):
     notes = TextAreaField("ملاحظات إضافية (اختياري)")
     
     submit = SubmitField("تأكيد الحجز")
+# =========================================
+# Availability index (in-memory)
+# =========================================
+class AvailabilityFeed:
+    """إشعار مستمعي SSE بالأيام التي تغيّر توفرها.
+
+    كل تغيير يأخذ رقم إصدار متزايداً؛ المستمع يتذكر آخر إصدار رآه وينتظر على
+    Condition حتى يظهر إصدار أحدث. None تعني أن كل الأيام تغيّرت.
+    """
+
+    def __init__(self, history: int = 512):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._changes = deque(maxlen=history)  # (version, date | None)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def publish(self, *days: date):
+        with self._cond:
+            for d in days or (None,):
+                self._version += 1
+                self._changes.append((self._version, d))
+            self._cond.notify_all()
+
+    def wait(self, since: int, timeout: float):
+        """(الإصدار الحالي، الأيام المتغيرة بعد since أو None لكل الأيام)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version > since, timeout)
+            if self._changes and self._changes[0][0] > since + 1:
+                return self._version, None  # فاتتنا تغييرات خرجت من السجل
+            changed = set()
+            for version, d in self._changes:
+                if version > since:
+                    if d is None:
+                        return self._version, None
+                    changed.add(d)
+            return self._version, changed
+
+availability_feed = AvailabilityFeed()
+
+class IntervalIndex:
+    """فواصل حجوزات يوم واحد [start, end) بالدقائق من منتصف الليل، مرتبة بالبداية.
+
+    أي فاصل يتداخل مع [s, e) تقع بدايته في (s - أطول مدة، e)، فيُحدد المرشحون
+    ببحث ثنائي وتكلفة الاستعلام O(log n + k).
+    """
+
+    __slots__ = ("starts", "ends", "weights", "longest")
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.weights = []
+        self.longest = 0
+
+    def add(self, start: int, end: int, weight: int = 1):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.weights.insert(i, weight)
+        self.longest = max(self.longest, end - start)
+
+    def _candidates(self, start: int, end: int) -> list[int]:
+        lo = bisect.bisect_right(self.starts, start - self.longest)
+        hi = bisect.bisect_left(self.starts, end)
+        return [i for i in range(lo, hi) if self.ends[i] > start]
+
+    def overlapping(self, start: int, end: int) -> list[tuple[int, int]]:
+        return [(self.starts[i], self.ends[i]) for i in self._candidates(start, end)]
+
+    def copy(self) -> "IntervalIndex":
+        other = IntervalIndex()
+        other.starts, other.ends, other.weights = list(self.starts), list(self.ends), list(self.weights)
+        other.longest = self.longest
+        return other
+
+    def peak(self, start: int, end: int) -> int:
+        """أعلى مجموع أوزان لفواصل متزامنة داخل [start, end)
+
+        الاستخدام لا يتغير إلا عند بداية فاصل، فيكفي فحص start وبدايات المتداخلين.
+        """
+        found = self._candidates(start, end)
+        points = [start] + [self.starts[i] for i in found if self.starts[i] > start]
+        return max(
+            (sum(self.weights[i] for i in found if self.starts[i] <= p < self.ends[i]) for p in points),
+            default=0,
+        )
+
+    def overlaps(self, start: int, end: int) -> bool:
+        return bool(self.overlapping(start, end))
+
+    def mask(self, slot_minutes: list[int], length: int) -> int:
+        """bitset المواعيد التي يتداخل فيها حجز طوله length مع أي فاصل"""
+        bits = 0
+        for i, m in enumerate(slot_minutes):
+            if self.overlaps(m, m + length):
+                bits |= 1 << i
+        return bits
+
+    def ranges(self) -> list[tuple[int, int]]:
+        """الفواصل بعد دمج المتداخل والمتلاصق منها"""
+        merged = []
+        for start, end in zip(self.starts, self.ends):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(r) for r in merged]
+
+
+class SlotIndex:
+    """فهرس الحجوزات النشطة في الذاكرة.
+
+    لكل تاريخ: {service_id: IntervalIndex} حيث يمثَّل كل حجز بالفاصل
+    [appointment_at, appointment_at + Service.duration_minutes).
+    يُحمَّل اليوم باستعلام واحد عند أول طلب، ويُسقط من الذاكرة عند أي تعديل
+    على حجوزاته أو بعد AVAILABILITY_TTL ثانية (لتتزامن عمّال gunicorn).
+    المدد والسعات مربوطة بـ CatalogVersion: إذا غيّرتها عملية أخرى سقط كل ما في الذاكرة.
+    """
+
+    MAX_DAYS = 400
+    CATALOG_CHECK = 1.0  # خارج الطلبات (CLI) يُفحص الإصدار مرة كل ثانية على الأكثر
+
+    def __init__(self, ttl: int = AVAILABILITY_TTL):
+        self.ttl = ttl
+        self.slots = time_slots()
+        self.slot_minutes = list(business_calendar.grid_minutes)
+        self._days = {}
+        self._durations = None
+        self._capacity = None
+        self._catalog = None  # إصدار CatalogVersion الذي حُمّلت عليه المدد والسعات
+        self._checked = float("-inf")
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def sync(self, exact: bool = False):
+        """إسقاط كل ما في الذاكرة إذا تغيّر CatalogVersion في القاعدة.
+
+        يُقرأ الإصدار مرة لكل طلب (أو كل CATALOG_CHECK ثانية خارج الطلبات)،
+        و exact يفرض القراءة الآن كما في مسار الكتابة و fresh.
+        """
+        if not exact:
+            if has_request_context():
+                checked = g.setdefault("catalog_checked", set())
+                if id(self) in checked:
+                    return
+                checked.add(id(self))
+            elif monotonic() - self._checked < self.CATALOG_CHECK:
+                return
+        self._checked = monotonic()
+        version = db.session.scalar(db.select(CatalogVersion.version).where(CatalogVersion.id == 1)) or 0
+        if version != self._catalog:
+            if self._catalog is not None:
+                self.invalidate()  # الأيام أيضاً: فواصلها محسوبة بالمدد القديمة
+            self._catalog = version
+
+    def durations(self) -> dict:
+        """{service_id: duration_minutes} لكل الخدمات (جدول صغير يُحمَّل حتى يتغيّر CatalogVersion)"""
+        self.sync()
+        durations = self._durations
+        if durations is None:
+            durations = dict(db.session.execute(db.select(Service.id, Service.duration_minutes)).all())
+            self._durations = durations
+        return durations
+
+    def duration(self, service_id: int) -> int:
+        return self.durations().get(service_id) or 60
+
+    def capacity(self) -> tuple[dict, dict]:
+        """(سعة كل نوع مورد، متطلبات كل خدمة) من جدولي Resource و ServiceRequirement.
+
+        الخدمة التي ليس لها متطلبات تأخذ مساراً خاصاً بها بسعة 1، أي أن حجزاً
+        واحداً لها فقط في نفس الوقت (السلوك السابق).
+        """
+        self.sync()
+        capacity = self._capacity
+        if capacity is None:
+            counts = dict(db.session.execute(
+                db.select(Resource.kind, db.func.count(Resource.id))
+                .where(Resource.active == True).group_by(Resource.kind)
+            ).all())
+            needs = {}
+            for service_id, kind, quantity in db.session.execute(
+                db.select(ServiceRequirement.service_id, ServiceRequirement.kind, ServiceRequirement.quantity)
+            ).all():
+                needs.setdefault(service_id, {})[kind] = quantity
+            capacity = self._capacity = (counts, needs)
+        return capacity
+
+    def requirements(self, service_id: int) -> dict:
+        """{مسار: الكمية المطلوبة} للخدمة"""
+        return self.capacity()[1].get(service_id) or {f"service:{service_id}": 1}
+
+    def lane_capacity(self, lane: str) -> int:
+        if lane.startswith("service:"):
+            return 1
+        return self.capacity()[0].get(lane, 0)
+
+    def lanes(self, day: dict) -> dict:
+        """{مسار: IntervalIndex موزون بالكمية المستهلكة} من حجوزات اليوم"""
+        lanes = {}
+        for service_id, intervals in day.items():
+            for lane, quantity in self.requirements(service_id).items():
+                usage = lanes.setdefault(lane, IntervalIndex())
+                for start, end in zip(intervals.starts, intervals.ends):
+                    usage.add(start, end, quantity)
+        return lanes
+
+    def remaining(self, day: dict, service_id: int, lanes: dict | None = None) -> list[int]:
+        """عدد الحجوزات الإضافية الممكنة لهذه الخدمة عند كل موعد في الشبكة"""
+        if lanes is None:
+            lanes = self.lanes(day)
+        length = self.duration(service_id)
+        needs = self.requirements(service_id)
+        result = []
+        for m in self.slot_minutes:
+            fits = None
+            for lane, quantity in needs.items():
+                usage = lanes.get(lane)
+                used = usage.peak(m, m + length) if usage else 0
+                free = max(self.lane_capacity(lane) - used, 0) // quantity
+                fits = free if fits is None else min(fits, free)
+            result.append(fits or 0)
+        return result
+
+    def _load(self, first: date, last: date) -> dict:
+        """تحميل الأيام [first, last] باستعلام نطاق واحد على appointment_at"""
+        start, _ = day_bounds(first)
+        _, end = day_bounds(last)
+        rows = db.session.execute(
+            db.select(Booking.service_id, Booking.appointment_at).where(
+                Booking.appointment_at >= start,
+                Booking.appointment_at < end,
+                Booking.status.in_(ACTIVE_STATUSES),
+            )
+        ).all()
+        days = {first + timedelta(days=n): {} for n in range((last - first).days + 1)}
+        for service_id, at in rows:
+            begin = _minutes(at)
+            days[at.date()].setdefault(service_id, IntervalIndex()).add(begin, begin + self.duration(service_id))
+        return days
+
+    def days(self, first: date, last: date, fresh: bool = False, viewer_id: int | None = None) -> dict:
+        """{date: {service_id: IntervalIndex}} للأيام من first إلى last (شاملة).
+
+        الحجوزات المؤقتة (hold_store) تُضاف فوق الحجوزات، عدا حجوزات المستخدم viewer_id نفسه.
+        """
+        days = self._booking_days(first, last, fresh)
+        for d, held in hold_store.held(first, last, exclude_user=viewer_id).items():
+            day = {service_id: intervals.copy() for service_id, intervals in days[d].items()}
+            for service_id, at in held:
+                begin = _minutes(at)
+                day.setdefault(service_id, IntervalIndex()).add(begin, begin + self.duration(service_id))
+            days[d] = day
+        return days
+
+    def _booking_days(self, first: date, last: date, fresh: bool = False) -> dict:
+        self.sync(exact=fresh)
+        now = monotonic()
+        wanted = [first + timedelta(days=n) for n in range((last - first).days + 1)]
+        result, missing = {}, []
+        with self._lock:
+            generation = self._generation
+            for d in wanted:
+                entry = self._days.get(d)
+                if entry and not fresh and now - entry[0] < self.ttl:
+                    result[d] = entry[1]
+                else:
+                    missing.append(d)
+        if not missing:
+            return result
+
+        loaded = self._load(missing[0], missing[-1])
+        with self._lock:
+            # لا نخزّن نتيجة قديمة إذا حصل تعديل أثناء التحميل
+            if generation == self._generation:
+                if len(self._days) + len(loaded) > self.MAX_DAYS:
+                    self._days = {k: v for k, v in self._days.items() if now - v[0] < self.ttl}
+                for d, day in loaded.items():
+                    self._days[d] = (now, day)
+        for d in missing:
+            result[d] = loaded[d]
+        return result
+
+    def day(self, d: date, fresh: bool = False, viewer_id: int | None = None) -> dict:
+        return self.days(d, d, fresh, viewer_id)[d]
+
+    def combine(self, day: dict, service_id: int | None = None) -> int:
+        """bitset المواعيد غير المتاحة.
+
+        مع service_id: المواعيد التي لا تتسع فيها الموارد لحجز جديد بمدة هذه الخدمة.
+        بدون service_id: المواعيد المشغولة بأي حجز.
+        """
+        if service_id is not None:
+            bits = 0
+            for i, free in enumerate(self.remaining(day, service_id)):
+                if not free:
+                    bits |= 1 << i
+            return bits
+        bits = 0
+        for intervals in day.values():
+            bits |= intervals.mask(self.slot_minutes, STEP_MINUTES)
+        return bits
+
+    def blocked_ranges(self, day: dict, service_id: int | None = None) -> list[list[str]]:
+        """الفترات المحجوزة [من، إلى) بصيغة HH:MM"""
+        if service_id is not None:
+            merged = day[service_id] if service_id in day else IntervalIndex()
+        else:
+            merged = IntervalIndex()
+            for intervals in day.values():
+                for start, end in zip(intervals.starts, intervals.ends):
+                    merged.add(start, end)
+        return [[_hhmm(start), _hhmm(end)] for start, end in merged.ranges()]
+
+    def mask(self, d: date, service_id: int | None = None, viewer_id: int | None = None) -> int:
+        return self.combine(self.day(d, viewer_id=viewer_id), service_id)
+
+    def booked(self, d: date, service_id: int | None = None, viewer_id: int | None = None) -> list[str]:
+        bits = self.mask(d, service_id, viewer_id)
+        return [s for i, s in enumerate(self.slots) if bits >> i & 1]
+
+    def remaining_on(self, d: date, day: dict, service_id: int) -> list[int]:
+        """remaining() مع تصفير المواعيد خارج دوام ذلك اليوم"""
+        open_bits = business_calendar.open_mask(d)
+        return [free if open_bits >> i & 1 else 0 for i, free in enumerate(self.remaining(day, service_id))]
+
+    def fits(self, service_id: int, when_dt: datetime, fresh: bool = False, viewer_id: int | None = None) -> bool:
+        """هل تتسع الموارد لحجز جديد لهذه الخدمة طوال مدتها؟"""
+        lanes = self.lanes(self.day(when_dt.date(), fresh, viewer_id))
+        begin = _minutes(when_dt)
+        end = begin + self.duration(service_id)
+        for lane, quantity in self.requirements(service_id).items():
+            usage = lanes.get(lane)
+            used = usage.peak(begin, end) if usage else 0
+            if used + quantity > self.lane_capacity(lane):
+                return False
+        return True
+
+    def invalidate(self, *days: date):
+        """إسقاط أيام من الذاكرة (أو كل الأيام إذا لم تُحدد) ليُعاد تحميلها عند الطلب التالي"""
+        with self._lock:
+            self._generation += 1
+            if not days:
+                self._days.clear()
+                self._durations = None
+                self._capacity = None
+            for d in days:
+                self._days.pop(d, None)
+        availability_feed.publish(*days)
+
+slot_index = SlotIndex()
+
+
+class HoldStore:
+    """حجز مؤقت للموعد (موعد واحد لكل مستخدم) أثناء تعبئة نموذج الحجز.
+
+    الحجز المؤقت صف في slot_hold وخلاياه صفوف في slot_reservation، فيحكمه قيد الخلايا
+    نفسه الذي يحكم الحجوزات عبر كل العمال. ينتهي بعد HOLD_TTL ثانية: المنتهي يُتجاهل
+    عند القراءة، وتُحرَّر خلاياه عند أول حجز يحتاجها أو عند expire().
+    """
+    EXPIRE_EVERY = 5  # أقل فاصل (ثوانٍ) بين عمليتي تنظيف في نفس العملية
+
+    def __init__(self, ttl: int = HOLD_TTL):
+        self.ttl = ttl
+        self._swept = 0.0
+        self._lock = threading.Lock()
+
+    def _drop(self, condition) -> set:
+        """حذف الحجوزات المؤقتة المطابقة مع خلاياها داخل معاملة المستدعي؛ يعيد أيامها"""
+        holds = db.session.execute(db.select(SlotHold.id, SlotHold.appointment_at).where(condition)).all()
+        if holds:
+            ids = [hold_id for hold_id, _ in holds]
+            db.session.execute(db.delete(SlotReservation).where(SlotReservation.hold_id.in_(ids)))
+            db.session.execute(db.delete(SlotHold).where(SlotHold.id.in_(ids)))
+        return {at.date() for _, at in holds}
+
+    def expire(self):
+        """إسقاط المنتهي وإشعار مستمعي التوفر بأيامه"""
+        with self._lock:
+            if monotonic() - self._swept < self.EXPIRE_EVERY:
+                return
+            self._swept = monotonic()
+        expired = self._drop(SlotHold.expires_at <= datetime.utcnow())
+        db.session.commit()
+        if expired:
+            availability_feed.publish(*expired)
+
+    def place(self, user_id: int, service_id: int, at: datetime) -> str | None:
+        """حجز مؤقت جديد يستبدل أي حجز مؤقت سابق لنفس المستخدم؛ None إذا لم تعد السعة تتسع"""
+        changed = self._drop(SlotHold.user_id == user_id)
+        token = uuid.uuid4().hex
+        hold = SlotHold(token=token, user_id=user_id, service_id=service_id, appointment_at=at,
+                        expires_at=datetime.utcnow() + timedelta(seconds=self.ttl))
+        db.session.add(hold)
+        db.session.flush()
+        if not _claim_cells(service_id, _reservation_cells(hold), hold_id=hold.id):
+            db.session.rollback()
+            return None
+        db.session.commit()
+        availability_feed.publish(at.date(), *changed)
+        return token
+
+    def release(self, user_id: int, token: str | None = None, commit: bool = True) -> set:
+        """تحرير الحجز المؤقت للمستخدم؛ يعيد أيامه (فارغة إذا لم يوجد).
+
+        مع commit=False يبقى الحذف في معاملة المستدعي وعليه إشعار availability_feed بعد الـ commit.
+        """
+        condition = SlotHold.user_id == user_id
+        if token:
+            condition = db.and_(condition, SlotHold.token == token)
+        released = self._drop(condition)
+        if commit:
+            db.session.commit()
+            if released:
+                availability_feed.publish(*released)
+        return released
+
+    def held(self, first: date, last: date, exclude_user: int | None = None) -> dict:
+        """{date: [(service_id, appointment_at)]} للحجوزات المؤقتة السارية من first إلى last"""
+        start, end = day_bounds(first)[0], day_bounds(last)[1]
+        stmt = db.select(SlotHold.service_id, SlotHold.appointment_at).where(
+            SlotHold.appointment_at >= start,
+            SlotHold.appointment_at < end,
+            SlotHold.expires_at > datetime.utcnow(),
+        )
+        if exclude_user is not None:
+            stmt = stmt.where(SlotHold.user_id != exclude_user)
+        held = {}
+        for service_id, at in db.session.execute(stmt):
+            held.setdefault(at.date(), []).append((service_id, at))
+        return held
+
+hold_store = HoldStore()
+
+class BookingBootstrap:
+    """بيانات صفحة الحجز في حمولة واحدة.
+
+    الجزء الثابت (الخدمات النشطة، نسخة كتالوج السيارات، إعدادات التقويم) يُحفظ في الذاكرة
+    حتى تتغير الخدمات أو تنتهي ttl؛ توفر التاريخ المطلوب يُقرأ من slot_index.
+    """
+
+    def __init__(self, ttl: int = AVAILABILITY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._static = None
+        self._loaded_at = 0.0
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._static = None
+            self._generation += 1
+
+    def _load(self) -> dict:
+        services = db.session.execute(
+            db.select(Service.id, Service.name, Service.duration_minutes, Service.price)
+            .where(Service.active == True).order_by(Service.name)
+        ).all()
+        today = date.today()
+        window = (today + timedelta(days=i) for i in range(AVAILABILITY_MAX_DAYS))
+        return {
+            "services": [
+                {"id": sid, "name": name, "duration": int(duration or 0), "price": float(price or 0)}
+                for sid, name, duration, price in services
+            ],
+            "car_catalog_version": CAR_CATALOG_VERSION,
+            "calendar": {
+                "step": business_calendar.step,
+                "slots": business_calendar.grid,
+                "closed_weekdays": [wd for wd in range(7) if not business_calendar.weekly_slots[wd]],
+                # العطل فقط؛ أيام الإغلاق الأسبوعية في closed_weekdays
+                "closed_dates": [
+                    d.isoformat() for d in window
+                    if business_calendar.weekly_slots[d.weekday()] and not business_calendar.is_open(d)
+                ],
+                "hold_ttl": hold_store.ttl,
+            },
+        }
+
+    def static(self) -> dict:
+        with self._lock:
+            if self._static is not None and monotonic() - self._loaded_at < self.ttl:
+                return self._static
+            generation = self._generation
+        data = self._load()
+        with self._lock:
+            if generation == self._generation:
+                self._static, self._loaded_at = data, monotonic()
+        return data
+
+    def payload(self, d: date, viewer_id: int | None = None) -> dict:
+        """الحمولة الكاملة لتاريخ d: الجزء الثابت + قناع التوفر لكل خدمة في ذلك اليوم"""
+        data = self.static()
+        day = slot_index.day(d, viewer_id=viewer_id)
+        masks = {str(s["id"]): _day_availability(d, day, s["id"])[0] for s in data["services"]}
+        return {**data, "date": d.isoformat(), "availability": {"closed": is_closed_day(d), "masks": masks}}
+
+booking_bootstrap = BookingBootstrap()
+
+@db.event.listens_for(db.session, "after_flush")
+def _collect_booking_days(session, flush_context):
+    """تجميع الأيام التي تغيّرت حجوزاتها (إنشاء/تغيير حالة/حذف) لتحديث الفهرس بعد الـ commit"""
+    days = session.info.setdefault("booking_days", set())
+    catalog = False
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Booking):
+            history = db.inspect(obj).attrs.appointment_at.history
+            for at in (*history.added, *history.unchanged, *history.deleted):
+                if at:
+                    days.add(at.date())
+        elif isinstance(obj, (Service, Resource, ServiceRequirement)):
+            # المدد والسعات تدخل في حساب كل الأيام
+            session.info["booking_days_all"] = catalog = True
+    if catalog:
+        # في نفس المعاملة، لتُسقط العمّال الأخرى نسختها في الذاكرة (SlotIndex.sync)
+        conn, table = session.connection(), CatalogVersion.__table__
+        if not conn.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1)).rowcount:
+            conn.execute(table.insert().values(id=1, version=1))
+
+@db.event.listens_for(db.session, "after_commit")
+def _refresh_slot_index(session):
+    if session.in_nested_transaction():
+        return  # savepoint فقط، التغييرات لم تُثبت بعد
+    days = session.info.pop("booking_days", None)
+    if session.info.pop("booking_days_all", False):
+        slot_index.invalidate()
+        booking_bootstrap.invalidate()
+    elif days:
+        slot_index.invalidate(*days)
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def _discard_booking_days(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("booking_days", None)
+        session.info.pop("booking_days_all", None)
+        session.info.pop("activity_users", None)
+        session.info.pop("cohorts_changed", None)
+
+# =========================================
+# User activity counters
+# =========================================
+def refresh_user_activity(conn, user_ids=None):
+    """إعادة حساب bookings_count و last_booking_at بتحديث واحد من الحجوزات والأرشيف.
+
+    user_ids=None يعيد حساب الجميع (rebuild-user-activity)، وإلا المستخدمين المتأثرين فقط.
+    """
+    def scalar(model, agg):
+        return db.select(agg(model)).where(model.user_id == User.id).scalar_subquery()
+
+    live_last = scalar(Booking, lambda m: db.func.max(m.appointment_at))
+    archived_last = scalar(ArchivedBooking, lambda m: db.func.max(m.appointment_at))
+    stmt = db.update(User).values(
+        bookings_count=scalar(Booking, lambda m: db.func.count(m.id))
+        + scalar(ArchivedBooking, lambda m: db.func.count(m.id)),
+        last_booking_at=db.case(
+            (archived_last > live_last, archived_last), else_=db.func.coalesce(live_last, archived_last)
+        ),
+    )
+    if user_ids is not None:
+        if not user_ids:
+            return
+        stmt = stmt.where(User.id.in_(user_ids))
+    conn.execute(stmt)
+
+def ensure_user_activity() -> bool:
+    """إضافة الأعمدة والفهارس لقاعدة قديمة؛ True إذا أُضيفت الأعمدة الآن وتحتاج refresh_user_activity"""
+    with db.engine.begin() as conn:
+        columns = {c["name"] for c in db.inspect(conn).get_columns("user")}
+        added = "bookings_count" not in columns
+        if added:
+            conn.execute(db.text('ALTER TABLE "user" ADD COLUMN bookings_count INTEGER NOT NULL DEFAULT 0'))
+        if "last_booking_at" not in columns:
+            kind = "DATETIME" if conn.dialect.name == "sqlite" else "TIMESTAMP"
+            conn.execute(db.text(f'ALTER TABLE "user" ADD COLUMN last_booking_at {kind}'))
+            added = True
+        for name, table, column in (
+            ("ix_user_bookings_count", "user", "bookings_count"),
+            ("ix_user_last_booking_at", "user", "last_booking_at"),
+            ("ix_booking_user_id", "booking", "user_id"),
+        ):
+            conn.execute(db.text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({column})'))
+    return added
+
+@db.event.listens_for(db.session, "after_flush")
+def _collect_activity_users(session, flush_context):
+    """أصحاب الحجوزات المُنشأة/المحذوفة/المعدّلة في هذا الـ flush"""
+    user_ids = session.info.setdefault("activity_users", set())
+    for obj in (*session.new, *session.deleted):
+        if isinstance(obj, Booking):
+            user_ids.add(obj.user_id)
+    for obj in session.dirty:
+        if not isinstance(obj, Booking):
+            continue
+        state = db.inspect(obj)
+        history = state.attrs.user_id.history
+        if history.has_changes() or any(
+            state.attrs[f].history.has_changes() for f in ("appointment_at", "status")
+        ):
+            user_ids.update(history.deleted or ())
+            user_ids.add(obj.user_id)
+    user_ids.discard(None)
+
+@db.event.listens_for(db.session, "after_flush_postexec")
+def _sync_user_activity(session, flush_context):
+    """تحديث عدّاداتهم في نفس المعاملة بعد انتهاء الـ flush"""
+    user_ids = session.info.pop("activity_users", None)
+    if not user_ids:
+        return
+    refresh_user_activity(session.connection(), user_ids)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, User) and obj.id in user_ids:
+            session.expire(obj, ["bookings_count", "last_booking_at"])
+
+# =========================================
+# Service price history
+# =========================================
+class PriceBook:
+    """سجل الأسعار في الذاكرة: لكل خدمة تواريخ السريان مرتبة وأسعارها.
+
+    price_at() بحث bisect بلا استعلام، فالتقارير وفلتر currency لا تسأل القاعدة لكل حجز.
+    يُعاد تحميله عند تغيير سعر (بعد الـ commit) أو بعد ttl لتتزامن عمّال gunicorn،
+    لذا هو للقراءة حسب التاريخ فقط؛ لقطة الحجز الجديد تُقرأ من القاعدة.
+    """
+
+    def __init__(self, ttl: int = AVAILABILITY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._books = None
+        self._loaded_at = 0.0
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._books = None
+            self._generation += 1
+
+    def _load(self) -> dict:
+        books = {}
+        for service_id, effective_from, price in db.session.execute(
+            db.select(ServicePrice.service_id, ServicePrice.effective_from, ServicePrice.price)
+            .order_by(ServicePrice.service_id, ServicePrice.effective_from, ServicePrice.id)
+        ):
+            dates, prices = books.setdefault(service_id, ([], []))
+            dates.append(effective_from)
+            prices.append(price)
+        return books
+
+    def books(self) -> dict:
+        with self._lock:
+            if self._books is not None and monotonic() - self._loaded_at < self.ttl:
+                return self._books
+            generation = self._generation
+        books = self._load()
+        with self._lock:
+            if generation == self._generation:
+                self._books, self._loaded_at = books, monotonic()
+        return books
+
+    def price_at(self, service_id: int, when: datetime):
+        """السعر الساري للخدمة في when؛ ما قبل أول سجل يأخذ أقدم سعر، و None إن لم يوجد سجل"""
+        entry = self.books().get(service_id)
+        if not entry:
+            return None
+        dates, prices = entry
+        return prices[max(bisect.bisect_right(dates, when) - 1, 0)]
+
+price_book = PriceBook()
+
+def booking_price(booking):
+    """لقطة السعر المخزّنة مع الحجز، أو السعر الساري وقت موعده للحجوزات الأقدم من اللقطات"""
+    if booking.price is not None:
+        return booking.price
+    return price_book.price_at(booking.service_id, booking.appointment_at)
+
+@db.event.listens_for(db.session, "before_flush")
+def _snapshot_booking_price(session, flush_context, instances):
+    """الحجز الجديد (أو الذي تغيّرت خدمته) يحفظ السعر الساري الآن.
+
+    يُقرأ من صف الخدمة في نفس المعاملة لا من price_book (نسخة العامل قد تكون قديمة
+    حتى ttl)؛ price_book للقراءة حسب التاريخ في التقارير فقط.
+    """
+    for obj in (*session.new, *session.dirty):
+        if not isinstance(obj, Booking) or obj.service_id is None:
+            continue
+        if obj in session.new and obj.price is not None:
+            continue
+        if obj not in session.new and not db.inspect(obj).attrs.service_id.history.has_changes():
+            continue
+        with session.no_autoflush:
+            obj.price = session.scalar(db.select(Service.price).where(Service.id == obj.service_id))
+
+@db.event.listens_for(db.session, "after_flush")
+def _record_service_price(session, flush_context):
+    """سجل سعر جديد عند إضافة خدمة أو تغيير سعرها"""
+    rows = [
+        {"service_id": s.id, "price": s.price, "effective_from": datetime.now()}
+        for s in (*session.new, *session.dirty)
+        if isinstance(s, Service) and s.price is not None
+        and (s in session.new or db.inspect(s).attrs.price.history.has_changes())
+    ]
+    if rows:
+        session.connection().execute(ServicePrice.__table__.insert(), rows)
+        session.info["prices_changed"] = True
+
+@db.event.listens_for(db.session, "after_commit")
+def _refresh_price_book(session):
+    if not session.in_nested_transaction() and session.info.pop("prices_changed", False):
+        price_book.invalidate()
+
+def ensure_price_history() -> bool:
+    """أعمدة لقطة السعر لقاعدة قديمة، وسجل أول لكل خدمة إن كان السجل فارغاً.
+
+    True إذا وُجدت حجوزات بلا لقطة لخدمة لها سجل أسعار وتحتاج backfill_booking_prices()؛
+    حجوزات خدمة حُذفت مع سجلها تبقى بلا لقطة ولا تُعد في كل ترقية.
+    """
+    with db.engine.begin() as conn:
+        for table in ("booking", "booking_archive"):
+            if "price" not in {c["name"] for c in db.inspect(conn).get_columns(table)}:
+                conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN price NUMERIC(10, 2)"))
+    if db.session.scalar(db.select(ServicePrice.id).limit(1)) is None:
+        # لا تاريخ قبل هذه الترقية: السعر الحالي يُعد سارياً منذ البداية
+        db.session.execute(db.insert(ServicePrice).from_select(
+            ["service_id", "price", "effective_from"],
+            db.select(Service.id, Service.price, db.literal(datetime(2000, 1, 1), db.DateTime)),
+        ))
+        db.session.commit()
+        price_book.invalidate()
+    return any(
+        db.session.scalar(db.select(model.id).where(*_unpriced(model)).limit(1)) is not None
+        for model in (Booking, ArchivedBooking)
+    )
+
+def _unpriced(model) -> tuple:
+    """شرط الحجوزات بلا لقطة سعر التي يمكن تعبئتها من سجل الأسعار"""
+    return model.price.is_(None), model.service_id.in_(db.select(ServicePrice.service_id))
+
+def backfill_booking_prices(batch: int = 1000) -> int:
+    """تعبئة لقطة السعر للحجوزات القديمة بالسعر الساري وقت موعدها (bisect في الذاكرة، تحديث لكل دفعة)"""
+    total = 0
+    for model in (Booking, ArchivedBooking):
+        table = model.__table__
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                db.select(model.id, model.service_id, model.appointment_at)
+                .where(*_unpriced(model), model.id > last_id).order_by(model.id).limit(batch)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            # خدمة حُذفت ولا سجل لها تبقى بلا لقطة
+            values = [{"row_id": i, "snapshot": price_book.price_at(sid, at)} for i, sid, at in rows]
+            values = [v for v in values if v["snapshot"] is not None]
+            if values:
+                db.session.connection().execute(
+                    table.update().where(table.c.id == db.bindparam("row_id")).values(price=db.bindparam("snapshot")),
+                    values,
+                )
+            db.session.commit()
+            total += len(values)
+    return total
+
+# =========================================
+# Reports (rollups)
+# =========================================
+REVENUE_STATUSES = ("approved",)
+REPORT_PERIODS = ("day", "week", "month")
+REPORT_MAX_POINTS = 120
+# نتائج تحليل الأفواج تُحفظ في الذاكرة لكل نطاق (ثواني)، وتُقرأ الحجوزات على دفعات
+COHORT_CACHE_TTL = int(os.environ.get("COHORT_CACHE_TTL", "900"))
+COHORT_CACHE_SIZE = 32
+COHORT_CHUNK = 5000
+# شعبية الخدمات: وزن الحجز يتنصف كل POPULARITY_HALF_LIFE_DAYS يوماً، ولا يُحسب ما هو أقدم من النافذة
+POPULARITY_HALF_LIFE_DAYS = float(os.environ.get("POPULARITY_HALF_LIFE_DAYS", "30"))
+POPULARITY_WINDOW_DAYS = int(os.environ.get("POPULARITY_WINDOW_DAYS", "180"))
+
+def _day_runs(days):
+    """الأيام كنطاقات متصلة [من، إلى) لشرط يستخدم فهرس appointment_at"""
+    runs = []
+    for d in sorted(days):
+        if runs and runs[-1][1] == d:
+            runs[-1][1] = d + timedelta(days=1)
+        else:
+            runs.append([d, d + timedelta(days=1)])
+    return runs
+
+def refresh_rollups(conn, days=None):
+    """إعادة حساب booking_rollup للأيام days (أو للكل) من الحجوزات والأرشيف بعبارتين"""
+    rows_q = booking_rows(include_archive=True)
+    day = db.func.date(rows_q.c.appointment_at)
+    source = (
+        db.select(
+            day, rows_q.c.service_id, rows_q.c.status, db.func.count(),
+            db.func.coalesce(db.func.sum(db.func.coalesce(rows_q.c.price, Service.price)), 0),
+            db.func.coalesce(db.func.sum(Service.duration_minutes), 0),
+        )
+        .select_from(rows_q)
+        .outerjoin(Service, Service.id == rows_q.c.service_id)
+        .group_by(day, rows_q.c.service_id, rows_q.c.status)
+    )
+    clear = db.delete(BookingRollup)
+    if days is not None:
+        if not days:
+            return
+        runs = _day_runs(days)
+        source = source.where(db.or_(*(
+            db.and_(rows_q.c.appointment_at >= day_bounds(a)[0], rows_q.c.appointment_at < day_bounds(b)[0])
+            for a, b in runs
+        )))
+        clear = clear.where(db.or_(*(db.and_(BookingRollup.day >= a, BookingRollup.day < b) for a, b in runs)))
+    conn.execute(clear)
+    conn.execute(db.insert(BookingRollup).from_select(
+        ["day", "service_id", "status", "bookings", "revenue", "minutes"], source
+    ))
+
+def ensure_rollups() -> bool:
+    """True إذا كان booking_rollup فارغاً مع وجود حجوزات (أول تشغيل بعد الترقية)"""
+    if db.session.scalar(db.select(BookingRollup.day).limit(1)) is not None:
+        return False
+    return any(
+        db.session.scalar(db.select(model.id).limit(1)) is not None for model in (Booking, ArchivedBooking)
+    )
+
+@db.event.listens_for(db.session, "after_flush")
+def _collect_rollup_days(session, flush_context):
+    """أيام الحجوزات المُنشأة/المعدّلة/المحذوفة في هذا الـ flush (القديمة والجديدة)"""
+    days = session.info.setdefault("rollup_days", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Booking):
+            history = db.inspect(obj).attrs.appointment_at.history
+            days.update(at.date() for at in (*history.added, *history.unchanged, *history.deleted) if at)
+
+@db.event.listens_for(db.session, "after_flush_postexec")
+def _sync_rollups(session, flush_context):
+    days = session.info.pop("rollup_days", None)
+    if days:
+        refresh_rollups(session.connection(), days)
+
+def period_start(d: date, period: str) -> date:
+    """بداية اليوم/الأسبوع (من السبت)/الشهر الذي يقع فيه d"""
+    if period == "month":
+        return d.replace(day=1)
+    if period == "week":
+        return d - timedelta(days=(d.weekday() - CALENDAR_WEEK_START) % 7)
+    return d
+
+def rollup_totals(first: date, last: date) -> dict:
+    """إجماليات [first, last) من التجميعات: الحجوزات النشطة والملغاة والإيراد والدقائق"""
+    active = BookingRollup.status.in_(ACTIVE_STATUSES)
+    bookings, cancelled, revenue, minutes = db.session.execute(
+        db.select(
+            db.func.coalesce(db.func.sum(db.case((active, BookingRollup.bookings), else_=0)), 0),
+            db.func.coalesce(db.func.sum(db.case((BookingRollup.status == "cancelled", BookingRollup.bookings), else_=0)), 0),
+            db.func.coalesce(db.func.sum(db.case((BookingRollup.status.in_(REVENUE_STATUSES), BookingRollup.revenue), else_=0)), 0),
+            db.func.coalesce(db.func.sum(db.case((active, BookingRollup.minutes), else_=0)), 0),
+        ).where(BookingRollup.day >= first, BookingRollup.day < last)
+    ).one()
+    return {"bookings": int(bookings), "cancelled": int(cancelled), "revenue": float(revenue), "minutes": int(minutes)}
+
+def rollup_series(first: date, last: date, period: str = "day", max_points: int = REPORT_MAX_POINTS) -> list[dict]:
+    """سلسلة [first, last) مجمّعة باليوم/الأسبوع/الشهر، ومقلّصة إلى max_points نقطة على الأكثر.
+
+    التقليص يدمج الفترات المتجاورة بالجمع (لا أخذ عينات) فتبقى المجاميع صحيحة.
+    """
+    active = BookingRollup.status.in_(ACTIVE_STATUSES)
+    rows = db.session.execute(
+        db.select(
+            BookingRollup.day,
+            db.func.sum(db.case((active, BookingRollup.bookings), else_=0)),
+            db.func.sum(db.case((BookingRollup.status == "cancelled", BookingRollup.bookings), else_=0)),
+            db.func.sum(db.case((BookingRollup.status.in_(REVENUE_STATUSES), BookingRollup.revenue), else_=0)),
+        )
+        .where(BookingRollup.day >= first, BookingRollup.day < last)
+        .group_by(BookingRollup.day)
+    )
+    buckets = {}
+    d = period_start(first, period)
+    while d < last:
+        buckets[d] = [0, 0, 0.0]
+        d = (d + timedelta(days=32)).replace(day=1) if period == "month" else d + timedelta(days=7 if period == "week" else 1)
+    for day, bookings, cancelled, revenue in rows:
+        cell = buckets[period_start(day, period)]
+        cell[0] += int(bookings or 0)
+        cell[1] += int(cancelled or 0)
+        cell[2] += float(revenue or 0)
+    keys = list(buckets)
+    step = max(1, -(-len(keys) // max(1, max_points)))
+    series = []
+    for i in range(0, len(keys), step):
+        group = keys[i:i + step]
+        series.append({
+            "start": group[0].isoformat(),
+            "bookings": sum(buckets[k][0] for k in group),
+            "cancelled": sum(buckets[k][1] for k in group),
+            "revenue": round(sum(buckets[k][2] for k in group), 2),
+        })
+    return series
+
+def utilization_heatmap(first: date, last: date) -> dict:
+    """نسبة إشغال الغرف (bay) لكل (يوم أسبوع، موعد من time_slots()) في [first, last).
+
+    تُسحب البدايات والمدد كمصفوفات وتُحسب تغطية كل حجز لكل خلية دفعة واحدة بـ NumPy
+    (مصفوفة حجوزات × خلايا)، ثم تُجمع لكل يوم أسبوع بضرب مصفوفات. المقام عدد الأيام
+    المفتوحة من كل يوم أسبوع في النطاق × السعة بنموذج SlotIndex: الغرف + مسار بسعة 1 لكل
+    خدمة بلا متطلبات، فلا تتجاوز النسبة 100%. المواعيد المغلقة تبقى فارغة.
+    """
+    step = business_calendar.step
+    grid = np.array(business_calendar.grid_minutes, dtype=np.int64)
+    rows_q = booking_rows(include_archive=True)
+    rows = db.session.execute(
+        db.select(rows_q.c.appointment_at, db.func.coalesce(Service.duration_minutes, 60), rows_q.c.service_id)
+        .select_from(rows_q)
+        .outerjoin(Service, Service.id == rows_q.c.service_id)
+        .where(
+            rows_q.c.appointment_at >= day_bounds(first)[0], rows_q.c.appointment_at < day_bounds(last)[0],
+            rows_q.c.status.in_(ACTIVE_STATUSES),
+        )
+    ).all()
+
+    bays = slot_index.lane_capacity("bay")
+    # الخدمات ذات المسار الخاص: النشطة والمحجوزة في النطاق (ولو أُوقفت لاحقاً)
+    service_ids = set(db.session.scalars(db.select(Service.id).where(Service.active == True))) | {r[2] for r in rows}
+    private = sum(1 for i in service_ids if next(iter(slot_index.requirements(i))).startswith("service:"))
+    busy = np.zeros((7, len(grid)))
+    if rows and len(grid):
+        at, duration, service_id = zip(*rows)
+        start = np.array(at, dtype="datetime64[m]").astype(np.int64)
+        minute = start % 1440
+        weekday = (start // 1440 + 3) % 7  # 1970-01-01 كان خميساً
+        end = minute + np.array(duration, dtype=np.int64)
+        # كم غرفة يشغلها كل حجز؛ الخدمة بلا متطلبات (مسارها الخاص) تُحسب غرفة واحدة
+        ids, inverse = np.unique(np.array(service_id, dtype=np.int64), return_inverse=True)
+        needs = [slot_index.requirements(int(i)) for i in ids]
+        need = np.array([r.get("bay", int(len(r) == 1 and next(iter(r)).startswith("service:"))) for r in needs], dtype=float)[inverse]
+        overlap = np.clip(
+            np.minimum(end[:, None], grid[None, :] + step) - np.maximum(minute[:, None], grid[None, :]), 0, step
+        ) / step
+        busy = (weekday[None, :] == np.arange(7)[:, None]).astype(float) @ (overlap * need[:, None])
+
+    days = np.arange(np.datetime64(first), np.datetime64(last), dtype="datetime64[D]")
+    if business_calendar.holidays:
+        days = days[~np.isin(days, np.array(sorted(business_calendar.holidays), dtype="datetime64[D]"))]
+    open_days = np.bincount((days.astype(np.int64) + 3) % 7, minlength=7)
+    is_open = np.array([[bool(mask >> i & 1) for i in range(len(grid))] for mask in business_calendar.weekly_masks])
+    capacity = open_days[:, None] * is_open * max(bays + private, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(capacity > 0, busy / capacity, np.nan)
+
+    order = [(CALENDAR_WEEK_START + i) % 7 for i in range(7)]
+    return {
+        "slots": business_calendar.grid,
+        "rows": [
+            (wd, WEEKDAY_NAMES[wd], [None if np.isnan(v) else round(float(v), 3) for v in ratio[wd]])
+            for wd in order if is_open[wd].any()
+        ],
+        "bookings": len(rows),
+        "bays": bays,
+        "private": private,
+    }
+
+def _month_index(values) -> np.ndarray:
+    """رقم الشهر منذ 1970 لمصفوفة تواريخ/أوقات"""
+    return np.array(values, dtype="datetime64[M]").astype(np.int64)
+
+class CohortReport:
+    """أفواج العملاء حسب شهر التسجيل: الحجز الأول، العودة لخدمة ثانية، والاحتفاظ شهراً بشهر.
+
+    يُقرأ عمودا العملاء (id، created_at) وأعمدة حجوزاتهم (الحي + الأرشيف) على دفعات
+    كمصفوفات، ثم تُحسب كل المقاييس بـ NumPy (bincount / unique / minimum.at) دون كائنات ORM.
+    النتيجة تُحفظ لكل (نطاق، خدمة أولى، خدمة لاحقة) حتى ttl أو حتى commit يغيّر عميلاً أو حجزاً.
+    """
+
+    def __init__(self, ttl: int = COHORT_CACHE_TTL, size: int = COHORT_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def result(self, first: date, last: date, first_service: int | None = None, then_service: int | None = None) -> dict:
+        """أفواج الأشهر [first, last) (بدايات أشهر)، مع مسار first_service ثم then_service إن حُددا"""
+        key = (first, last, first_service, then_service)
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit and monotonic() - hit[0] < self.ttl:
+                return hit[1]
+        data = self._compute(first, last, first_service, then_service)
+        with self._lock:
+            if len(self._cache) >= self.size:
+                self._cache.pop(min(self._cache, key=lambda k: self._cache[k][0]))
+            self._cache[key] = (monotonic(), data)
+        return data
+
+    @staticmethod
+    def _columns(stmt, dtypes) -> list[np.ndarray]:
+        """تنفيذ stmt على دفعات؛ كل دفعة تُحوَّل فوراً إلى مصفوفة بنوع عمودها ثم تُوصل المصفوفات،
+        فلا يبقى في الذاكرة من كائنات Python إلا دفعة واحدة"""
+        chunks = [[] for _ in dtypes]
+        for part in db.session.execute(stmt.execution_options(yield_per=COHORT_CHUNK)).partitions():
+            for column, values, dtype in zip(chunks, zip(*part), dtypes):
+                column.append(np.array(values, dtype=dtype))
+        return [np.concatenate(c) if c else np.zeros(0, dtype=dtype) for c, dtype in zip(chunks, dtypes)]
+
+    def _compute(self, first: date, last: date, first_service, then_service) -> dict:
+        base = _month_index([first])[0]
+        months = int(_month_index([last])[0] - base)
+        current = int(_month_index([date.today()])[0] - base)
+        # نفس مجموعة العملاء في الاستعلامين: من يسجّل ويحجز بينهما لا يدخل أياً منهما
+        top = db.session.scalar(db.select(db.func.max(User.id))) or 0
+        in_range = db.and_(
+            User.id <= top, User.created_at >= day_bounds(first)[0], User.created_at < day_bounds(last)[0]
+        )
+        user_id, created_at = self._columns(
+            db.select(User.id, User.created_at).where(in_range).order_by(User.id), (np.int64, "datetime64[m]")
+        )
+        cohort = _month_index(created_at) - base
+
+        rows_q = booking_rows(include_archive=True)
+        b_user, b_service, b_at = self._columns(
+            db.select(rows_q.c.user_id, rows_q.c.service_id, rows_q.c.appointment_at).where(
+                rows_q.c.status.in_(ACTIVE_STATUSES),
+                rows_q.c.user_id.in_(db.select(User.id).where(in_range)),
+            ),
+            (np.int64, np.int64, "datetime64[m]"),
+        )
+        owner = np.searchsorted(user_id, b_user)
+        # احتياط: حجز لعميل ليس في القائمة (تغيّر تاريخ تسجيله بين الاستعلامين) يُهمل
+        known = owner < len(user_id)
+        known[known] = user_id[owner[known]] == b_user[known]
+        if not known.all():
+            owner, b_service, b_at = owner[known], b_service[known], b_at[known]
+        at = b_at.astype(np.int64)
+        # الشهر منذ التسجيل؛ حجز مسجّل قبل الحساب (بيانات قديمة) يُعد في الشهر صفر
+        offset = np.clip(_month_index(b_at) - base - cohort[owner], 0, None)
+
+        size = np.bincount(cohort, minlength=months)
+        visits = np.bincount(owner, minlength=len(user_id))
+        booked = np.bincount(cohort[visits > 0], minlength=months)
+        returned = np.bincount(cohort[visits > 1], minlength=months)
+
+        # احتفاظ: عدد العملاء المختلفين في كل (فوج، شهر منذ التسجيل)
+        active = np.zeros((months, months), dtype=np.int64)
+        keep = offset < months
+        if keep.any():
+            pairs = np.unique(owner[keep] * months + offset[keep])
+            np.add.at(active, (cohort[pairs // months], pairs % months), 1)
+
+        took_first = followed = None
+        if first_service and then_service:
+            none = np.iinfo(np.int64)
+            first_at = np.full(len(user_id), none.max)
+            is_first = b_service == first_service
+            np.minimum.at(first_at, owner[is_first], at[is_first])
+            then_at = np.full(len(user_id), none.min)
+            is_then = b_service == then_service
+            np.maximum.at(then_at, owner[is_then], at[is_then])
+            took_first = np.bincount(cohort[first_at < none.max], minlength=months)
+            followed = np.bincount(cohort[then_at > first_at], minlength=months)
+
+        rows = []
+        for i in range(months):
+            month = (np.datetime64(first, "M") + i).astype(object)
+            n = int(size[i])
+            rows.append({
+                "month": month,
+                "size": n,
+                "booked": int(booked[i]),
+                "returned": int(returned[i]),
+                "took_first": None if took_first is None else int(took_first[i]),
+                "followed": None if followed is None else int(followed[i]),
+                # حتى الشهر الحالي فقط؛ ما بعده لم يأتِ بعد لهذا الفوج
+                "retention": [
+                    round(float(active[i, k]) / n, 3) if n else 0.0 for k in range(max(0, min(months, current - i + 1)))
+                ],
+            })
+        return {
+            "rows": rows, "months": months, "customers": int(len(user_id)), "bookings": int(len(owner)),
+            "computed_at": datetime.now(),
+        }
+
+cohort_report = CohortReport()
+
+@db.event.listens_for(db.session, "after_flush")
+def _collect_cohort_changes(session, flush_context):
+    if any(isinstance(obj, (User, Booking)) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["cohorts_changed"] = True
+
+@db.event.listens_for(db.session, "after_commit")
+def _refresh_cohort_report(session):
+    if not session.in_nested_transaction() and session.info.pop("cohorts_changed", False):
+        cohort_report.invalidate()
+
+def refresh_popularity(now: datetime | None = None) -> dict:
+    """حساب Service.popularity من حجوزات النافذة: مجموع 0.5 ** (العمر بالأيام / نصف العمر).
+
+    الحجوزات القادمة وزنها 1، والملغاة لا تُحسب. تحديث واحد لكل الخدمات (executemany).
+    """
+    now = now or datetime.now()
+    rows = db.session.execute(
+        db.select(Booking.service_id, Booking.appointment_at).where(
+            Booking.appointment_at >= now - timedelta(days=POPULARITY_WINDOW_DAYS),
+            Booking.status.in_(ACTIVE_STATUSES),
+        )
+    ).all()
+    scores = {}
+    if rows:
+        service_id, at = zip(*rows)
+        ids, inverse = np.unique(np.array(service_id, dtype=np.int64), return_inverse=True)
+        age = np.clip((np.datetime64(now, "m") - np.array(at, dtype="datetime64[m]")).astype(np.int64), 0, None) / 1440
+        weights = 0.5 ** (age / POPULARITY_HALF_LIFE_DAYS)
+        scores = {int(i): round(float(v), 4) for i, v in zip(ids, np.bincount(inverse, weights=weights))}
+    table = Service.__table__
+    service_ids = db.session.scalars(db.select(Service.id)).all()
+    if service_ids:
+        db.session.connection().execute(
+            table.update().where(table.c.id == db.bindparam("sid")).values(popularity=db.bindparam("score")),
+            [{"sid": i, "score": scores.get(i, 0.0)} for i in service_ids],
+        )
+    db.session.commit()
+    return scores
+
+def ensure_service_popularity() -> bool:
+    """عمود الشعبية وفهرسه لقاعدة قديمة؛ True إذا أُضيف الآن ويحتاج refresh_popularity()"""
+    with db.engine.begin() as conn:
+        added = "popularity" not in {c["name"] for c in db.inspect(conn).get_columns("service")}
+        if added:
+            conn.execute(db.text("ALTER TABLE service ADD COLUMN popularity FLOAT NOT NULL DEFAULT 0"))
+        conn.execute(db.text(
+            "CREATE INDEX IF NOT EXISTS ix_service_active_popularity ON service (active, popularity)"
+        ))
+    return added
+
+@db.event.listens_for(db.session, "before_flush")
+def _seed_service_popularity(session, flush_context, instances):
+    """الخدمة الجديدة تبدأ بوسيط شعبية الخدمات النشطة حتى يحسبها refresh-popularity،
+    فتظهر وسط الصفحة الرئيسية بدل آخرها"""
+    new = [obj for obj in session.new if isinstance(obj, Service) and obj.popularity is None]
+    if not new:
+        return
+    with session.no_autoflush:
+        scores = session.scalars(db.select(Service.popularity).where(Service.active == True)).all()
+    for service in new:
+        service.popularity = round(float(np.median(scores)), 4) if scores else 0.0
+
+# =========================================
+# Search index (FTS)
+# =========================================
+# رمز user باقٍ في مخطط المفاتيح فقط: العملاء يُبحث عنهم في user_search_term
+SEARCH_KINDS = {"user": 1, "booking": 2, "car": 3}
+SEARCH_LIMIT = 30
+
+def _phone_variants(phone: str) -> list[str]:
+    """الرقم المخزّن +966… مع صيغه المحلية، ليُطابق البحث بأي صيغة يكتبها الموظف"""
+    digits = re.sub(r"\D", "", clean_phone_number(phone or ""))
+    local = digits[3:] if digits.startswith("966") else digits
+    return [digits, local, "0" + local] if local else []
+
+def search_text(obj) -> str:
+    """النص المفهرس لكل كيان (ملاحظات حجز، سيارة)"""
+    if isinstance(obj, Booking):
+        return (obj.notes or "").strip()
+    if isinstance(obj, CarInfo):
+        plate = obj.plate_number or ""
+        return " ".join(filter(None, [obj.brand, obj.model, plate, plate.replace(" ", "")]))
+    return ""
+
+class SearchIndex:
+    """فهرس بحث نصي لملاحظات الحجوزات والسيارات (العملاء في user_search_term).
+
+    SQLite: جدول FTS5 (search_fts) بترتيب bm25. PostgreSQL: جدول search_document بعمود tsvector
+    مولَّد وفهرس GIN، وفهرس trigram (pg_trgm) للمطابقة الجزئية إن توفر الامتداد.
+    مفتاح الصف ref_id * 4 + رمز النوع، فتحديث أي كيان كتابة مباشرة بالمفتاح.
+    """
+
+    FIELDS = {Booking: ("notes",), CarInfo: ("brand", "model", "plate_number")}
+    KIND_OF = {Booking: "booking", CarInfo: "car"}
+
+    def __init__(self):
+        self.enabled = False
+        self.trigram = False
+
+    @staticmethod
+    def key(kind: str, ref_id: int) -> int:
+        return ref_id * 4 + SEARCH_KINDS[kind]
+
+    @staticmethod
+    def split_key(key: int) -> tuple[str, int]:
+        code = key % 4
+        return next(k for k, c in SEARCH_KINDS.items() if c == code), key // 4
+
+    def ensure(self, reset: bool = False, create: bool = True) -> bool:
+        """إنشاء جدول الفهرس إن لم يوجد (مع create)؛ True إذا أُنشئ الآن ويحتاج rebuild()"""
+        sqlite = db.engine.dialect.name == "sqlite"
+        table = "search_fts" if sqlite else "search_document"
+        if reset:
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f"DROP TABLE IF EXISTS {table}"))
+        with db.engine.connect() as conn:
+            exists = db.inspect(conn).has_table(table)
+            if not sqlite:
+                self.trigram = bool(conn.scalar(db.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")))
+        if exists or not create:
+            self.enabled = exists
+            return False
+        try:
+            if sqlite:
+                with db.engine.begin() as conn:
+                    conn.execute(db.text(
+                        "CREATE VIRTUAL TABLE search_fts USING fts5(body, tokenize='unicode61 remove_diacritics 2')"
+                    ))
+            else:
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(db.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                    self.trigram = True
+                except DBAPIError:
+                    self.trigram = False
+                with db.engine.begin() as conn:
+                    conn.execute(db.text(
+                        "CREATE TABLE search_document (id BIGINT PRIMARY KEY, body TEXT NOT NULL, "
+                        "tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED)"
+                    ))
+                    conn.execute(db.text("CREATE INDEX ix_search_document_tsv ON search_document USING gin (tsv)"))
+                    if self.trigram:
+                        conn.execute(db.text(
+                            "CREATE INDEX ix_search_document_trgm ON search_document USING gin (body gin_trgm_ops)"
+                        ))
+        except DBAPIError as e:
+            app.logger.warning("تعذر إنشاء فهرس البحث: %s", e)
+            self.enabled = False
+            return False
+        self.enabled = True
+        return True
+
+    def write(self, conn, docs: dict):
+        """docs: {مفتاح: نص}؛ النص الفارغ أو None يحذف الصف"""
+        if not self.enabled or not docs:
+            return
+        keys = list(docs)
+        rows = [{"id": k, "body": body} for k, body in docs.items() if body]
+        if conn.dialect.name == "sqlite":
+            conn.execute(db.text("DELETE FROM search_fts WHERE rowid IN :ids").bindparams(
+                db.bindparam("ids", expanding=True)), {"ids": keys})
+            if rows:
+                conn.execute(db.text("INSERT INTO search_fts (rowid, body) VALUES (:id, :body)"), rows)
+        else:
+            empty = [k for k in keys if not docs[k]]
+            if empty:
+                conn.execute(db.text("DELETE FROM search_document WHERE id IN :ids").bindparams(
+                    db.bindparam("ids", expanding=True)), {"ids": empty})
+            if rows:
+                conn.execute(db.text(
+                    "INSERT INTO search_document (id, body) VALUES (:id, :body) "
+                    "ON CONFLICT (id) DO UPDATE SET body = EXCLUDED.body"
+                ), rows)
+
+    def forget(self, conn, kind: str, ids):
+        """حذف صفوف الفهرس لكيانات حُذفت بعبارة جماعية (لا تمر بأحداث الجلسة)"""
+        self.write(conn, {self.key(kind, ref_id): None for ref_id in ids})
+
+    def drop_kind(self, kind: str) -> int:
+        """حذف كل صفوف نوع من الفهرس (مثل صفوف العملاء من نسخة أقدم)؛ يعيد عددها"""
+        if not self.enabled:
+            return 0
+        table = "search_fts" if db.engine.dialect.name == "sqlite" else "search_document"
+        key = "rowid" if table == "search_fts" else "id"
+        with db.engine.begin() as conn:
+            result = conn.execute(db.text(f"DELETE FROM {table} WHERE {key} % 4 = :code"), {"code": SEARCH_KINDS[kind]})
+            return result.rowcount
+
+    def search(self, q: str, limit: int = SEARCH_LIMIT) -> list[tuple[str, int]]:
+        """[(النوع، المعرف)] مرتبة بالأهمية؛ كل كلمة في q تُطابق كبادئة"""
+        tokens = re.findall(r"\w+", q or "")
+        if not self.enabled or not tokens:
+            return []
+        if db.engine.dialect.name == "sqlite":
+            match = " AND ".join(f'"{t}"*' for t in tokens)
+            rows = db.session.execute(db.text(
+                "SELECT rowid FROM search_fts WHERE search_fts MATCH :q ORDER BY bm25(search_fts) LIMIT :n"
+            ), {"q": match, "n": limit}).scalars().all()
+        else:
+            tsquery = " & ".join(f"{t}:*" for t in tokens)
+            if self.trigram:
+                sql = ("SELECT id FROM search_document WHERE tsv @@ to_tsquery('simple', :q) OR body % :raw "
+                       "ORDER BY ts_rank(tsv, to_tsquery('simple', :q)) + similarity(body, :raw) DESC LIMIT :n")
+            else:
+                sql = ("SELECT id FROM search_document WHERE tsv @@ to_tsquery('simple', :q) "
+                       "ORDER BY ts_rank(tsv, to_tsquery('simple', :q)) DESC LIMIT :n")
+            rows = db.session.execute(db.text(sql), {"q": tsquery, "raw": q, "n": limit}).scalars().all()
+        return [self.split_key(k) for k in rows]
+
+    def rebuild(self, batch: int = 1000) -> int:
+        """إعادة فهرسة كل الحجوزات (ذات الملاحظات) والسيارات"""
+        total = 0
+        conn = db.session.connection()
+        conn.execute(db.text("DELETE FROM search_fts" if conn.dialect.name == "sqlite" else "DELETE FROM search_document"))
+        for model, kind in self.KIND_OF.items():
+            for chunk in db.session.scalars(db.select(model).execution_options(yield_per=batch)).partitions():
+                self.write(conn, {self.key(kind, obj.id): search_text(obj) for obj in chunk})
+                total += len(chunk)
+        db.session.commit()
+        return total
+
+search_index = SearchIndex()
+
+@db.event.listens_for(db.session, "after_flush")
+def _sync_search_index(session, flush_context):
+    """تحديث صفوف الفهرس داخل نفس المعاملة عند إنشاء/تعديل/حذف عميل أو حجز أو سيارة"""
+    if not search_index.enabled:
+        return
+    docs = {}
+    for obj in (*session.new, *session.dirty):
+        fields = SearchIndex.FIELDS.get(type(obj))
+        if not fields:
+            continue
+        state = db.inspect(obj)
+        if obj in session.new or any(state.attrs[f].history.has_changes() for f in fields):
+            docs[search_index.key(SearchIndex.KIND_OF[type(obj)], obj.id)] = search_text(obj)
+    for obj in session.deleted:
+        if type(obj) in SearchIndex.KIND_OF:
+            docs[search_index.key(SearchIndex.KIND_OF[type(obj)], obj.id)] = None
+    search_index.write(session.connection(), docs)
+
+# =========================================
+# Normalized user search
+# =========================================
+ARABIC_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ة": "ه", "ى": "ي", "ـ": None,
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # ٠-٩
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # ۰-۹
+})
+ARABIC_DIACRITICS = re.compile(r"[\u064B-\u065F\u0670]")
+
+def fold_arabic(text: str) -> str:
+    """توحيد صور الألف والتاء المربوطة والألف المقصورة وحذف التشكيل والتطويل"""
+    return ARABIC_DIACRITICS.sub("", (text or "").translate(ARABIC_FOLD)).casefold()
+
+def user_search_terms(user) -> set[str]:
+    """كلمات الاسم المطبّعة وصيغ الرقم (966…، 5…، 05…) كما يُخزّنها user_search_term"""
+    words = re.findall(r"\w+", fold_arabic(user.full_name))
+    return {w[:64] for w in words} | set(_phone_variants(user.phone))
+
+def _like_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _term_match(token: str):
+    """شرط بادئة على term يستخدم الفهرس؛ ومع pg_trgm مطابقة جزئية داخل الكلمة"""
+    term = UserSearchTerm.term
+    if db.engine.dialect.name == "sqlite":
+        # LIKE في SQLite لا يستخدم فهرساً بترتيب BINARY، أما المدى فيستخدمه
+        return db.and_(term >= token, term < token + "\U0010FFFF")
+    if search_index.trigram and len(token) >= 3:
+        return term.like(f"%{_like_escape(token)}%", escape="\\")
+    return term.like(f"{_like_escape(token)}%", escape="\\")
+
+def user_search_condition(q: str):
+    """شرط على User: كل كلمة في q تطابق (كبادئة) كلمة من اسمه أو صيغة من رقمه"""
+    folded = fold_arabic(q)
+    if re.fullmatch(r"[\d\s+()-]+", folded) and any(c.isdigit() for c in folded):
+        tokens = [re.sub(r"\D", "", clean_phone_number(folded))]
+    else:
+        tokens = re.findall(r"\w+", folded)
+    if not any(tokens):
+        return db.false()  # لا كلمات (رموز فقط): لا يطابق أحداً بدل and_() الفارغ الذي يطابق الكل
+    return db.and_(*(
+        User.id.in_(db.select(UserSearchTerm.user_id).where(_term_match(t[:64]))) for t in tokens
+    ))
+
+def ensure_user_search() -> bool:
+    """فهارس PostgreSQL الإضافية؛ True إذا كان الجدول فارغاً مع وجود عملاء ويحتاج rebuild_user_search()"""
+    if db.engine.dialect.name != "sqlite":
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                "CREATE INDEX IF NOT EXISTS ix_user_search_term_prefix ON user_search_term (term text_pattern_ops)"
+            ))
+            if search_index.trigram:
+                conn.execute(db.text(
+                    "CREATE INDEX IF NOT EXISTS ix_user_search_term_trgm ON user_search_term USING gin (term gin_trgm_ops)"
+                ))
+    has_terms = db.session.scalar(db.select(UserSearchTerm.user_id).limit(1)) is not None
+    return not has_terms and db.session.scalar(db.select(User.id).limit(1)) is not None
+
+def rebuild_user_search(batch: int = 1000) -> int:
+    """إعادة توليد user_search_term لكل العملاء"""
+    table = UserSearchTerm.__table__
+    conn = db.session.connection()
+    conn.execute(table.delete())
+    total = 0
+    for chunk in db.session.scalars(db.select(User).execution_options(yield_per=batch)).partitions():
+        rows = [{"term": t, "user_id": u.id} for u in chunk for t in user_search_terms(u)]
+        if rows:
+            conn.execute(table.insert(), rows)
+        total += len(chunk)
+    db.session.commit()
+    return total
+
+@db.event.listens_for(db.session, "after_flush")
+def _sync_user_search_terms(session, flush_context):
+    """إعادة كتابة كلمات العميل عند إنشائه أو تغيير اسمه/رقمه، وحذفها مع حذفه"""
+    changed = [
+        u for u in (*session.new, *session.dirty)
+        if isinstance(u, User) and (u in session.new or any(
+            db.inspect(u).attrs[f].history.has_changes() for f in ("full_name", "phone")
+        ))
+    ]
+    stale = [u.id for u in (*changed, *session.deleted) if isinstance(u, User)]
+    if not stale:
+        return
+    table = UserSearchTerm.__table__
+    conn = session.connection()
+    conn.execute(table.delete().where(table.c.user_id.in_(stale)))
+    rows = [{"term": t, "user_id": u.id} for u in changed for t in user_search_terms(u)]
+    if rows:
+        conn.execute(table.insert(), rows)
 
 # ===== Route للحصول على موديلات السيارة =====
 @app.route("/api/car-models/<brand>")
@@ -566,81 +2495,277 @@ def get_car_models(brand):
     models = CAR_BRANDS.get(brand, [])
     return jsonify(models)
 
+@app.route("/api/car-catalog")
+def get_car_catalog():
+    """كتالوج السيارات كاملاً؛ مع ?v=<النسخة> يُخزّن في المتصفح دون إعادة طلب"""
+    response = jsonify(version=CAR_CATALOG_VERSION, brands=CAR_BRANDS)
+    if request.args.get("v") == CAR_CATALOG_VERSION:
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    return response
+
+@app.route("/api/booking-bootstrap")
+@login_required
+def get_booking_bootstrap():
+    """حمولة صفحة الحجز لتاريخ واحد (?date=YYYY-MM-DD، الافتراضي اليوم) مع ETag للتخزين لكل تاريخ"""
+    try:
+        d = date.fromisoformat(request.args.get("date") or date.today().isoformat())
+    except ValueError:
+        return jsonify(error="date يجب أن يكون بصيغة YYYY-MM-DD"), 400
+    response = jsonify(booking_bootstrap.payload(d, current_user.id))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
 # ===== تحديث route الحجز =====
 @app.route("/api/booked-slots/<date>")
 @login_required
 def get_booked_slots(date):
     try:
         target_date = datetime.strptime(date, '%Y-%m-%d').date()
-        bookings = db.session.scalars(
-            db.select(Booking).where(
-                db.func.date(Booking.appointment_at) == target_date,
-                Booking.status.in_(["pending", "approved"])
-            )
-        ).all()
-        booked_slots = [b.appointment_at.strftime("%H:%M") for b in bookings]
-        return jsonify(booked_slots)
-    except:
+    except ValueError:
         return jsonify([])
+    service_id = request.args.get("service_id", type=int)
+    return jsonify(slot_index.booked(target_date, service_id, current_user.id))
+
+AVAILABILITY_MAX_DAYS = 62
+SSE_MAX_DATES = 31
+
+def _day_availability(d: date, day: dict, service_id: int | None = None):
+    """(قناع hex للمواعيد غير المتاحة، الفترات المحجوزة) ليوم واحد؛ اليوم المغلق قناعه كامل"""
+    full = (1 << len(slot_index.slots)) - 1
+    if is_closed_day(d):
+        return format(full, "x"), []
+    bits = slot_index.combine(day, service_id) | (full & ~business_calendar.open_mask(d))
+    return format(bits, "x"), slot_index.blocked_ranges(day, service_id)
+
+@app.route("/api/availability")
+@login_required
+def get_availability():
+    """توفر عدة أيام في طلب واحد.
+
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD (to غير مشمول، الافتراضي أسبوع) و service_id اختياري.
+    كل يوم يُعاد كقناع hex على شبكة slots: البت i = الموعد slots[i] غير متاح،
+    والأيام المغلقة تُعاد بقناع كامل وتُذكر في closed.
+    blocked: الفترات المحجوزة [من، إلى) لكل يوم فيه حجوزات.
+    """
+    try:
+        start = datetime.strptime(request.args.get("from", ""), "%Y-%m-%d").date()
+        to_arg = request.args.get("to")
+        end = datetime.strptime(to_arg, "%Y-%m-%d").date() if to_arg else start + timedelta(days=7)
+    except ValueError:
+        return jsonify(error="from/to يجب أن تكون بصيغة YYYY-MM-DD"), 400
+    if not (start < end <= start + timedelta(days=AVAILABILITY_MAX_DAYS)):
+        return jsonify(error=f"النطاق يجب أن يكون بين يوم و {AVAILABILITY_MAX_DAYS} يوماً"), 400
+
+    service_id = request.args.get("service_id", type=int)
+    days, closed, blocked = {}, [], {}
+    for d, day in sorted(slot_index.days(start, end - timedelta(days=1), viewer_id=current_user.id).items()):
+        mask, ranges = _day_availability(d, day, service_id)
+        days[d.isoformat()] = mask
+        if is_closed_day(d):
+            closed.append(d.isoformat())
+        elif ranges:
+            blocked[d.isoformat()] = ranges
+    return jsonify({
+        "from": start.isoformat(), "to": end.isoformat(), "slots": slot_index.slots,
+        "days": days, "closed": closed, "blocked": blocked,
+    })
+
+_sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+@app.route("/api/availability/stream")
+@login_required
+def stream_availability():
+    """بث SSE لتغيّر توفر الأيام المراقبة: ?dates=YYYY-MM-DD,... &service_id= اختياري.
+
+    يُرسل حدث slots لكل يوم مراقب عند الاتصال ثم عند كل تغيير عليه (حجز، تغيير حالة،
+    حذف، حجز مؤقت)، بنفس صيغة /api/availability: {"date", "mask", "blocked"}.
+    إشعارات availability_feed من نفس العملية فقط، لذا يُعاد فحص الأيام من القاعدة عند كل
+    نبضة ولا يُرسل إلا ما تغيّر (تغييرات العمّال الآخرين تصل خلال SSE_HEARTBEAT ثانية).
+    """
+    try:
+        watched = sorted({
+            datetime.strptime(x.strip(), "%Y-%m-%d").date()
+            for x in request.args.get("dates", "").split(",") if x.strip()
+        })
+    except ValueError:
+        return jsonify(error="dates يجب أن تكون تواريخ بصيغة YYYY-MM-DD مفصولة بفواصل"), 400
+    if not 0 < len(watched) <= SSE_MAX_DATES:
+        return jsonify(error=f"راقب من يوم إلى {SSE_MAX_DATES} يوماً"), 400
+    service_id = request.args.get("service_id", type=int)
+    viewer_id = current_user.id
+    if not _sse_streams.acquire(blocking=False):
+        # لا خيوط متاحة للبث: المتصفح يستطلع /api/availability بدلاً منه
+        return jsonify(
+            error="البث المباشر مشغول، استخدم الاستطلاع",
+            poll=url_for("get_availability", service_id=service_id),
+        ), 503, {"Retry-After": str(SSE_HEARTBEAT)}
+    sent = {}
+
+    def events(dates, fresh=False):
+        days = slot_index.days(dates[0], dates[-1], fresh=fresh, viewer_id=viewer_id)
+        db.session.remove()  # لا نُبقي اتصال القاعدة مفتوحاً طوال البث
+        for d in dates:
+            mask, ranges = _day_availability(d, days[d], service_id)
+            payload = json.dumps({"date": d.isoformat(), "mask": mask, "blocked": ranges})
+            if sent.get(d) != payload:
+                sent[d] = payload
+                yield f"event: slots\ndata: {payload}\n\n"
+
+    def generate():
+        version = availability_feed.version
+        deadline = monotonic() + SSE_MAX_SECONDS
+        yield "retry: 3000\n\n"
+        yield from events(watched)
+        while monotonic() < deadline:
+            hold_store.expire()
+            version, changed = availability_feed.wait(version, SSE_HEARTBEAT)
+            dates = watched if changed is None else [d for d in watched if d in changed]
+            pushed = False
+            for event in events(dates or watched, fresh=not dates):
+                pushed = True
+                yield event
+            if not pushed:
+                yield ": ping\n\n"
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(_sse_streams.release)
+    return response
+
+@app.route("/api/capacity/<date>")
+@login_required
+def get_capacity(date):
+    """السعة المتبقية لخدمة (?service_id=) عند كل موعد في اليوم"""
+    try:
+        target_date = datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify(error="التاريخ يجب أن يكون بصيغة YYYY-MM-DD"), 400
+    service_id = request.args.get("service_id", type=int)
+    if not service_id:
+        return jsonify(error="service_id مطلوب"), 400
+
+    remaining = slot_index.remaining_on(target_date, slot_index.day(target_date, viewer_id=current_user.id), service_id)
+    return jsonify({
+        "date": target_date.isoformat(), "service_id": service_id,
+        "slots": slot_index.slots, "remaining": remaining,
+    })
+
+NEXT_SLOTS_MAX = 20
+
+@app.route("/api/next-slots")
+@login_required
+def get_next_slots():
+    """أقرب N مواعيد متاحة لخدمة ابتداءً من تاريخ.
+
+    ?service_id= (مطلوب) &from=YYYY-MM-DD (الافتراضي اليوم) &n= (الافتراضي 5).
+    يُحمَّل كامل الأفق (AVAILABILITY_MAX_DAYS يوماً) باستعلام واحد ثم يُمسح في الذاكرة
+    متخطياً الأيام المغلقة والأوقات الماضية.
+    """
+    service_id = request.args.get("service_id", type=int)
+    if not service_id:
+        return jsonify(error="service_id مطلوب"), 400
+    try:
+        from_arg = request.args.get("from")
+        start = datetime.strptime(from_arg, "%Y-%m-%d").date() if from_arg else date.today()
+    except ValueError:
+        return jsonify(error="from يجب أن يكون بصيغة YYYY-MM-DD"), 400
+    limit = min(max(request.args.get("n", 5, type=int), 1), NEXT_SLOTS_MAX)
+
+    now = datetime.now()
+    start = max(start, now.date())
+    found = []
+    days = slot_index.days(start, start + timedelta(days=AVAILABILITY_MAX_DAYS - 1), viewer_id=current_user.id)
+    for d in sorted(days):
+        if is_closed_day(d):
+            continue
+        for slot, free in zip(slot_index.slots, slot_index.remaining_on(d, days[d], service_id)):
+            if free and compose_datetime(d, slot) > now:
+                found.append({"date": d.isoformat(), "time": slot, "remaining": free})
+                if len(found) == limit:
+                    return jsonify(found)
+    return jsonify(found)
+
+@app.route("/api/holds", methods=["POST"])
+@login_required
+def place_hold():
+    """حجز مؤقت لموعد عند اختياره في النموذج: service_id, date, time (JSON أو form)"""
+    data = request.get_json(silent=True) or request.form
+    try:
+        service_id = int(data.get("service_id"))
+        appt_dt = compose_datetime(datetime.strptime(data.get("date", ""), "%Y-%m-%d").date(), data.get("time", ""))
+    except (TypeError, ValueError):
+        return jsonify(error="service_id و date و time مطلوبة"), 400
+
+    if is_closed_day(appt_dt.date()) or not within_business_hours(appt_dt) or appt_dt < datetime.now():
+        return jsonify(error="الموعد خارج أوقات الحجز"), 400
+    if is_conflicting(service_id, appt_dt, current_user.id):
+        return jsonify(error="الموعد غير متاح"), 409
+
+    token = hold_store.place(current_user.id, service_id, appt_dt)
+    if token is None:
+        return jsonify(error="الموعد غير متاح"), 409
+    return jsonify(token=token, expires_in=hold_store.ttl), 201
+
+@app.route("/api/holds/<token>", methods=["DELETE"])
+@login_required
+def release_hold(token):
+    if not hold_store.release(current_user.id, token):
+        return jsonify(error="لا يوجد حجز مؤقت بهذا الرمز"), 404
+    return "", 204
 
 @app.route("/book", methods=["GET","POST"])
 @limiter.limit("100 per hour")  # 10 حجوزات كل ساعة
 @login_required
 def book():
     form = CarBookingForm()
-    services = db.session.scalars(
-        db.select(Service).where(Service.active == True).order_by(Service.name)
-    ).all()
-    form.service_id.choices = [(s.id, f"{s.name} — {int(s.duration_minutes)}د") for s in services]
+    # الخدمات والتقويم وتوفر التاريخ من حمولة واحدة مخزّنة في الذاكرة
+    try:
+        target_date = datetime.strptime(request.form.get('date') or request.args.get('date') or "", '%Y-%m-%d').date()
+    except ValueError:
+        target_date = date.today()
+    bootstrap = booking_bootstrap.payload(target_date, current_user.id)
+    form.service_id.choices = [(s["id"], f'{s["name"]} — {s["duration"]}د') for s in bootstrap["services"]]
     form.time.choices = [(s, s) for s in time_slots()]
 
     # Preselect service by ?service_id=
-    try:
-        pre_id = request.args.get("service_id", type=int)
-        if pre_id:
-            _s = db.session.get(Service, pre_id)
-            if _s and _s.active:
-                form.service_id.data = pre_id
-    except Exception:
-        pass
+    pre_id = request.args.get("service_id", type=int)
+    if pre_id and any(s["id"] == pre_id for s in bootstrap["services"]):
+        form.service_id.data = pre_id
     booked_slots = []
-    selected_date = request.form.get('date') or request.args.get('date')
-    if selected_date:
-        try:
-            target_date = datetime.strptime(selected_date, '%Y-%m-%d').date()
-            bookings = db.session.scalars(
-                db.select(Booking).where(
-                    db.func.date(Booking.appointment_at) == target_date,
-                    Booking.status.in_(["pending", "approved"])
-                )
-            ).all()
-            booked_slots = [b.appointment_at.strftime("%H:%M") for b in bookings]
-        except:
-            pass
+    if request.form.get('date') or request.args.get('date'):
+        booked_slots = slot_index.booked(target_date, form.service_id.data or None, current_user.id)
     if form.validate_on_submit():
         # التحقق من يوم الإغلاق
         if is_closed_day(form.date.data):
-            day_name = ["الاثنين", "الثلاثاء", "الأربعاء", "الخميس", "الجمعة", "السبت", "الأحد"][form.date.data.weekday()]
+            day_name = WEEKDAY_NAMES[form.date.data.weekday()]
             if form.date.data.weekday() == 4:  # الجمعة
                 flash(f"عذراً، نحن مغلقون يوم الجمعة. اختر يوماً آخر.", "warning")
             elif form.date.data.weekday() in CLOSED_WEEKDAYS:
                 flash(f"عذراً، نحن مغلقون يوم {day_name}. اختر يوماً آخر.", "warning")
             else:
                 flash("هذا التاريخ ضمن العطل الرسمية. الرجاء اختيار تاريخ آخر.", "warning")
-            return render_template("booking_form.html", form=form, booked_slots=booked_slots)
+            return render_template("booking_form.html", form=form, booked_slots=booked_slots, bootstrap=bootstrap)
 
         appt_dt = compose_datetime(form.date.data, form.time.data)
         if appt_dt < datetime.now():
             flash("لا يمكن اختيار وقت في الماضي.", "warning")
-            return render_template("booking_form.html", form=form, booked_slots=booked_slots)
+            return render_template("booking_form.html", form=form, booked_slots=booked_slots, bootstrap=bootstrap)
 
         if not within_business_hours(appt_dt):
-            flash("الدوام من 1:00 ظهراً إلى 10:00 مساءً (آخر موعد يبدأ 9:30).", "warning")
-            return render_template("booking_form.html", form=form, booked_slots=booked_slots)
+            open_s, close_s, last_s = business_calendar.hours_for(form.date.data)
+            flash(f"الدوام من {open_s} إلى {close_s} (آخر موعد يبدأ {last_s}).", "warning")
+            return render_template("booking_form.html", form=form, booked_slots=booked_slots, bootstrap=bootstrap)
 
-        if is_conflicting(form.service_id.data, appt_dt):
-            flash("هذا الموعد محجوز بالفعل لهذه الخدمة. اختر وقتاً آخر.", "warning")
-            return render_template("booking_form.html", form=form, booked_slots=booked_slots)
+        if is_conflicting(form.service_id.data, appt_dt, current_user.id):
+            flash("لا تتوفر سعة لهذه الخدمة في هذا الموعد. اختر وقتاً آخر.", "warning")
+            return render_template("booking_form.html", form=form, booked_slots=booked_slots, bootstrap=bootstrap)
 
         # حفظ معلومات السيارة
         car_info = CarInfo(
@@ -664,12 +2789,23 @@ def book():
             car_info_id=car_info.id  # ربط معلومات السيارة
         )
         db.session.add(b)
+        db.session.flush()
+
+        # القيد الفريد على slot_reservation هو الحكم عند تسابق حجزين على نفس الموعد؛
+        # الحجز المؤقت للمستخدم يُحرَّر في نفس المعاملة حتى لا تحجب خلاياه حجزه هو
+        released = hold_store.release(current_user.id, commit=False)
+        if not reserve_slot(b):
+            db.session.rollback()
+            flash("سبقك حجز آخر إلى هذا الموعد. اختر وقتاً آخر.", "warning")
+            return render_template("booking_form.html", form=form, booked_slots=booked_slots, bootstrap=bootstrap)
         db.session.commit()
+        if released:
+            availability_feed.publish(*released)
         
         flash("تم إرسال طلب الحجز بنجاح مع معلومات السيارة. بانتظار موافقة الإدارة.", "success")
         return redirect(url_for("my_bookings"))
 
-    return render_template("booking_form.html", form=form, booked_slots=booked_slots)
+    return render_template("booking_form.html", form=form, booked_slots=booked_slots, bootstrap=bootstrap)
 
 # ===== إضافة command لتحديث قاعدة البيانات =====
 @app.cli.command("add-car-table")
@@ -787,24 +2923,36 @@ class ContactForm(FlaskForm):
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
+# نسخة بيانات التواصل لكل الصفحات، تُقرأ من القاعدة كل AVAILABILITY_TTL ثانية أو عند حفظها
+_contact_cache = {}
+
 @app.context_processor
 def inject_contact():
-    try:
-        c = ContactInfo.get_single(create_if_missing=True)
-    except Exception:
-        c = None
-    return dict(contact_global=c)
+    if "value" not in _contact_cache or monotonic() - _contact_cache["at"] > AVAILABILITY_TTL:
+        try:
+            c = ContactInfo.get_single(create_if_missing=True)
+        except Exception:
+            return dict(contact_global=None)
+        _contact_cache["value"] = SimpleNamespace(
+            **{col.name: getattr(c, col.name) for col in ContactInfo.__table__.columns}
+        )
+        _contact_cache["at"] = monotonic()
+    return dict(contact_global=_contact_cache["value"])
 
 # =========================================
 # Routes
 # =========================================
 @app.route("/")
 def index():
+    # الترتيب بالشعبية المحسوبة مسبقاً (refresh-popularity) عبر فهرس (active, popularity)
     services = db.session.scalars(
-        db.select(Service).where(Service.active == True).order_by(Service.name)
+        db.select(Service).where(Service.active == True)
+        .order_by(Service.popularity.desc(), Service.name)
     ).all()
     offers = db.session.scalars(
-        db.select(Offer).where(Offer.active == True).order_by(Offer.id.desc())
+        db.select(Offer).outerjoin(Service, Offer.service_id == Service.id)
+        .where(Offer.active == True)
+        .order_by(db.func.coalesce(Service.popularity, 0).desc(), Offer.id.desc())
     ).all()
     return render_template("index.html", services=services, offers=offers)
 
@@ -906,7 +3054,9 @@ def admin_users():
     status = request.args.get('status', 'all')
     search = request.args.get('search', '')
     
-    query = db.select(User).order_by(User.created_at.desc())
+    sort = request.args.get('sort', 'recent')
+    
+    query = db.select(User)
     
     if status == 'active':
         query = query.where(User.is_active == True)
@@ -916,25 +3066,33 @@ def admin_users():
         query = query.where(User.is_admin == True)
     
     if search:
-        query = query.where(
-            db.or_(
-                User.full_name.contains(search),
-                User.phone.contains(search)
-            )
-        )
+        query = query.where(user_search_condition(search))
     
-    users = db.session.scalars(query).all()
+    # الترتيب بالنشاط قراءة مباشرة للعدّاد المخزّن وفهرسه
+    if sort == 'activity':
+        order = [(User.bookings_count, "desc"), (User.id, "desc")]
+    else:
+        sort, order = 'recent', [(keyset_date(User.created_at), "desc"), (User.id, "desc")]
+    page = keyset_page(
+        query, order,
+        after=request.args.get("after"), before=request.args.get("before"), per_page=ADMIN_PAGE_SIZE,
+    )
+    users = page.items
     
-    # إحصائيات
-    stats = {
-        'total': db.session.scalar(db.select(db.func.count(User.id))),
-        'active': db.session.scalar(db.select(db.func.count(User.id)).where(User.is_active == True)),
-        'blocked': db.session.scalar(db.select(db.func.count(User.id)).where(User.is_active == False)),
-        'admins': db.session.scalar(db.select(db.func.count(User.id)).where(User.is_admin == True))
-    }
+    # إحصائيات في مرور واحد على الجدول
+    def tally(cond):
+        return db.func.coalesce(db.func.sum(db.case((cond, 1), else_=0)), 0)
+
+    total, active, blocked, admins = db.session.execute(db.select(
+        db.func.count(User.id),
+        tally(User.is_active == True),
+        tally(User.is_active == False),
+        tally(User.is_admin == True),
+    )).one()
+    stats = {'total': total, 'active': active, 'blocked': blocked, 'admins': admins}
     
-    return render_template("admin_users.html", users=users, stats=stats, 
-                         current_status=status, search=search)
+    return render_template("admin_users.html", users=users, stats=stats, page=page,
+                         current_status=status, search=search, sort=sort)
 
 @app.route("/admin/users/new", methods=["GET", "POST"])
 @login_required
@@ -1026,11 +3184,25 @@ def admin_user_delete(user_id):
         return redirect(url_for("admin_users"))
     
     # حذف حجوزات المستخدم أولاً
+    user_bookings = db.select(Booking.id).where(Booking.user_id == user.id)
+    booking_days = {
+        at.date() for at in db.session.scalars(db.union(
+            db.select(Booking.appointment_at).where(Booking.user_id == user.id),
+            db.select(ArchivedBooking.appointment_at).where(ArchivedBooking.user_id == user.id),
+        ))
+    }
+    db.session.execute(db.delete(SlotReservation).where(SlotReservation.booking_id.in_(user_bookings)))
+    hold_store.release(user.id, commit=False)
+    search_index.forget(db.session.connection(), "booking", db.session.scalars(user_bookings).all())
     db.session.execute(db.delete(Booking).where(Booking.user_id == user.id))
+    db.session.execute(db.delete(ArchivedBooking).where(ArchivedBooking.user_id == user.id))
+    db.session.execute(db.delete(ArchivedCarInfo).where(ArchivedCarInfo.user_id == user.id))
     
     user_name = user.full_name
     db.session.delete(user)
+    refresh_rollups(db.session.connection(), booking_days)
     db.session.commit()
+    slot_index.invalidate()  # الحذف الجماعي لا يمر على أحداث الـ ORM
     
     flash(f"تم حذف المستخدم {user_name} وجميع حجوزاته.", "warning")
     return redirect(url_for("admin_users"))
@@ -1058,27 +3230,138 @@ def my_bookings():
     return render_template("bookings.html", items=items)
 
 # ---------- Admin Routes ----------
+ADMIN_PAGE_SIZE = 20
+ADMIN_WINDOWS = {"today": "اليوم", "week": "هذا الأسبوع", "upcoming": "القادمة", "custom": "مخصص", "all": "الكل"}
+
+def admin_booking_window(args):
+    """نافذة التاريخ لقوائم الإدارة من ?window=today|week|upcoming|custom|all (custom مع from/to شاملة).
+
+    تعيد (window, from_date, to_date, start, end) حيث [start, end) على appointment_at وNone تعني بلا حد.
+    """
+    window = args.get("window", "upcoming")
+    today = date.today()
+    first = last = None
+    if window == "today":
+        first, last = today, today + timedelta(days=1)
+    elif window == "week":
+        first, last = calendar_range("week", today)
+    elif window == "custom":
+        try:
+            first = date.fromisoformat(args.get("from", ""))
+            last = date.fromisoformat(args.get("to", "")) + timedelta(days=1)
+        except ValueError:
+            window = "upcoming"
+        if window == "custom" and last <= first:
+            first, last = last - timedelta(days=1), first + timedelta(days=1)
+    elif window != "all":
+        window = "upcoming"
+    if window == "upcoming":
+        first, last = today, None
+    start = day_bounds(first)[0] if first else None
+    end = day_bounds(last)[0] if last else None
+    return window, first, (last - timedelta(days=1)) if last else None, start, end
+
+BOOKING_STATUSES = ("pending", "approved", "cancelled")
+
+def _window_where(start, end) -> list:
+    where = []
+    if start:
+        where.append(Booking.appointment_at >= start)
+    if end:
+        where.append(Booking.appointment_at < end)
+    return where
+
+def admin_status_counts(start, end) -> dict:
+    """عدد الحجوزات لكل حالة داخل النافذة باستعلام GROUP BY status واحد"""
+    counts = dict.fromkeys(BOOKING_STATUSES, 0)
+    counts.update(db.session.execute(
+        db.select(Booking.status, db.func.count(Booking.id)).where(*_window_where(start, end)).group_by(Booking.status)
+    ).all())
+    return counts
+
+def admin_booking_page(status: str, start, end, after=None, before=None, total: int | None = None):
+    """صفحة keyset (appointment_at, id) من حجوزات حالة واحدة داخل النافذة،
+    مع user/service/car_info محمّلة دفعة واحدة"""
+    where = [Booking.status == status, *_window_where(start, end)]
+    if total is None:
+        total = db.session.scalar(db.select(db.func.count(Booking.id)).where(*where))
+    page = keyset_page(
+        db.select(Booking)
+        .options(selectinload(Booking.user), selectinload(Booking.service), selectinload(Booking.car_info))
+        .where(*where),
+        [(Booking.appointment_at, "asc"), (Booking.id, "asc")],
+        after=after, before=before, per_page=ADMIN_PAGE_SIZE,
+    ) if total else KeysetPage([])
+    return {"status": status, "bookings": page.items, "total": total, "page": page}
+
+def _admin_list_urls():
+    """روابط صفحات القوائم: page_url للصفحة الكاملة و fragment_url لجزء التبويب (مع نفس النافذة)"""
+    window_args = {k: v for k, v in request.args.items() if k in ("window", "from", "to")}
+
+    def page_url(status, **cursor):
+        args = {f"{status}_{k}": v for k, v in cursor.items() if v}
+        return url_for("admin_home", **window_args, **args, tab=status)
+
+    def fragment_url(status, **cursor):
+        return url_for("admin_booking_list", status=status, **window_args, **{k: v for k, v in cursor.items() if v})
+
+    return page_url, fragment_url
+
 @app.route("/admin")
 @login_required
 def admin_home():
+    """لوحة الحجوزات: العدّادات من GROUP BY واحد، وقيد المراجعة فقط تُعرض مباشرة؛
+    المعتمدة والملغاة تُحمّل عند فتح تبويبها من admin_booking_list"""
     admin_required()
-    pending = db.session.scalars(
-        db.select(Booking).where(Booking.status == "pending").order_by(Booking.appointment_at.asc())
-    ).all()
-    approved = db.session.scalars(
-        db.select(Booking).where(Booking.status == "approved").order_by(Booking.appointment_at.asc())
-    ).all()
-    cancelled = db.session.scalars(
-        db.select(Booking).where(Booking.status == "cancelled").order_by(Booking.appointment_at.asc())
-    ).all()
-    return render_template("admin_home.html", pending=pending, approved=approved, cancelled=cancelled)
+    window, from_date, to_date, start, end = admin_booking_window(request.args)
+    counts = admin_status_counts(start, end)
+    pending = admin_booking_page(
+        "pending", start, end, request.args.get("pending_after"), request.args.get("pending_before"), counts["pending"]
+    )
+    page_url, fragment_url = _admin_list_urls()
+    tab = request.args.get("tab")
+    return render_template(
+        "admin_home.html",
+        pending=pending,
+        counts=counts,
+        tab=tab if tab in BOOKING_STATUSES else "pending",
+        tab_cursors={
+            s: {"after": request.args.get(f"{s}_after"), "before": request.args.get(f"{s}_before")}
+            for s in BOOKING_STATUSES
+        },
+        page_url=page_url,
+        fragment_url=fragment_url,
+        window=window,
+        windows=ADMIN_WINDOWS,
+        from_date=from_date,
+        to_date=to_date,
+    )
+
+@app.route("/admin/bookings/<status>")
+@login_required
+def admin_booking_list(status):
+    """جزء HTML لقائمة حالة واحدة (صفحة ?page= داخل نفس نافذة التاريخ)"""
+    admin_required()
+    if status not in BOOKING_STATUSES:
+        abort(404)
+    _, _, _, start, end = admin_booking_window(request.args)
+    page_url, fragment_url = _admin_list_urls()
+    return render_template(
+        "admin_booking_list.html",
+        info=admin_booking_page(status, start, end, request.args.get("after"), request.args.get("before")),
+        page_url=page_url,
+        fragment_url=fragment_url,
+    )
 
 @app.route("/admin/approve/<int:booking_id>", methods=["POST"])
 @login_required
 def admin_approve(booking_id):
     admin_required()
     b = db.session.get(Booking, booking_id) or abort(404)
-    b.status = "approved"
+    if not set_booking_status(b, "approved"):
+        db.session.rollback()
+        flash("لا يمكن الاعتماد: الموعد أصبح محجوزاً لحجز آخر.", "danger")
+        return redirect(url_for("admin_home"))
     db.session.commit()
     flash("تمت الموافقة على الحجز.", "success")
     return redirect(url_for("admin_home"))
@@ -1088,7 +3371,7 @@ def admin_approve(booking_id):
 def admin_cancel(booking_id):
     admin_required()
     b = db.session.get(Booking, booking_id) or abort(404)
-    b.status = "cancelled"
+    set_booking_status(b, "cancelled")
     db.session.commit()
     flash("تم إلغاء الحجز.", "info")
     return redirect(url_for("admin_home"))
@@ -1098,7 +3381,10 @@ def admin_cancel(booking_id):
 def admin_reset(booking_id):
     admin_required()
     b = db.session.get(Booking, booking_id) or abort(404)
-    b.status = "pending"
+    if not set_booking_status(b, "pending"):
+        db.session.rollback()
+        flash("لا يمكن إعادة الحجز: الموعد أصبح محجوزاً لحجز آخر.", "danger")
+        return redirect(url_for("admin_home"))
     db.session.commit()
     flash("تمت إعادة الحالة إلى قيد المراجعة.", "info")
     return redirect(url_for("admin_home"))
@@ -1113,13 +3399,283 @@ def admin_delete(booking_id):
     flash("تم حذف الحجز نهائياً.", "warning")
     return redirect(url_for("admin_home"))
 
+BULK_ACTIONS = {"approve": "approved", "cancel": "cancelled", "reset": "pending", "delete": None}
+BULK_MAX_IDS = 500
+
+@app.route("/admin/bookings/bulk", methods=["POST"])
+@login_required
+def admin_bookings_bulk():
+    """تطبيق إجراء واحد على عدة حجوزات: action + ids (JSON أو form).
+
+    الحالات تُقرأ باستعلام واحد ثم يُطبَّق UPDATE/DELETE جماعي في معاملة واحدة؛
+    النتيجة لكل رقم: ok أو unchanged أو not_found أو conflict (الموعد لم يعد متاحاً).
+    """
+    admin_required()
+    data = request.get_json(silent=True)
+    if data is None:
+        action, raw_ids = request.form.get("action"), request.form.getlist("ids")
+    else:
+        action, raw_ids = data.get("action"), data.get("ids") or []
+    try:
+        ids = list(dict.fromkeys(int(i) for i in raw_ids))
+    except (TypeError, ValueError):
+        return jsonify(error="ids يجب أن تكون أرقام حجوزات"), 400
+    if action not in BULK_ACTIONS:
+        return jsonify(error="action يجب أن يكون approve أو cancel أو reset أو delete"), 400
+    if not ids or len(ids) > BULK_MAX_IDS:
+        return jsonify(error=f"اختر من حجز إلى {BULK_MAX_IDS} حجزاً"), 400
+
+    rows = {
+        r.id: r for r in db.session.execute(
+            db.select(Booking.id, Booking.user_id, Booking.status, Booking.service_id, Booking.appointment_at)
+            .where(Booking.id.in_(ids))
+        )
+    }
+    target = BULK_ACTIONS[action]
+    results = {i: "not_found" for i in ids if i not in rows}
+    changed = [i for i, r in rows.items() if r.status != target]
+    results.update((i, "unchanged") for i, r in rows.items() if r.status == target)
+
+    failed = []
+    if changed:
+        if target not in ACTIVE_STATUSES:
+            db.session.execute(db.delete(SlotReservation).where(SlotReservation.booking_id.in_(changed)))
+        if target is None:
+            db.session.execute(db.delete(Booking).where(Booking.id.in_(changed)))
+            search_index.forget(db.session.connection(), "booking", changed)
+            refresh_user_activity(db.session.connection(), {rows[i].user_id for i in changed})
+        else:
+            db.session.execute(db.update(Booking).where(Booking.id.in_(changed)).values(status=target))
+        if target in ACTIVE_STATUSES:
+            # الحجوزات العائدة من الإلغاء تحتاج خلاياها من جديد؛ كل حجز في savepoint خاص به
+            for i in changed:
+                if rows[i].status in ACTIVE_STATUSES:
+                    continue
+                savepoint = db.session.begin_nested()
+                if reserve_slot(rows[i]):
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+                    failed.append(i)
+            for status in {rows[i].status for i in failed}:
+                db.session.execute(
+                    db.update(Booking)
+                    .where(Booking.id.in_([i for i in failed if rows[i].status == status]))
+                    .values(status=status)
+                )
+        # العبارات الجماعية لا تمر بأحداث الجلسة، فنحدّث تجميعات أيامها ونُبطلها يدوياً
+        days = {rows[i].appointment_at.date() for i in changed}
+        refresh_rollups(db.session.connection(), days)
+        db.session.commit()
+        slot_index.invalidate(*days)
+        cohort_report.invalidate()
+
+    results.update((i, "ok") for i in changed if i not in failed)
+    results.update((i, "conflict") for i in failed)
+    return jsonify(action=action, results={str(i): results[i] for i in ids})
+
+@app.route("/admin/calendar")
+@login_required
+def admin_calendar():
+    """تقويم أسبوعي/شهري: الخلايا من استعلام تجميعي واحد، وحجوزات اليوم تُحمّل عند فتحه"""
+    admin_required()
+    view = request.args.get("view", "week")
+    if view not in ("week", "month"):
+        view = "week"
+    try:
+        anchor = date.fromisoformat(request.args.get("start", ""))
+    except ValueError:
+        anchor = date.today()
+    include_archive = request.args.get("archive") == "1"
+
+    first, last = calendar_range(view, anchor)
+    days = [first + timedelta(days=i) for i in range((last - first).days)]
+    if view == "month":
+        month = anchor.replace(day=1)
+        prev_start = (month - timedelta(days=1)).replace(day=1)
+        next_start = (month + timedelta(days=32)).replace(day=1)
+        title = f"{MONTH_NAMES[month.month - 1]} {month.year}"
+    else:
+        prev_start, next_start = first - timedelta(days=7), first + timedelta(days=7)
+        title = f"{first.isoformat()} — {(last - timedelta(days=1)).isoformat()}"
+
+    return render_template(
+        "admin_calendar.html",
+        view=view,
+        title=title,
+        anchor=anchor,
+        weeks=[days[i:i + 7] for i in range(0, len(days), 7)],
+        weekday_names=WEEKDAY_NAMES,
+        summary=booking_day_summary(first, last, include_archive),
+        include_archive=include_archive,
+        services=dict(db.session.execute(db.select(Service.id, Service.name)).all()),
+        closed={d for d in days if is_closed_day(d)},
+        prev_start=prev_start,
+        next_start=next_start,
+        today=date.today(),
+    )
+
+@app.route("/admin/calendar/<day>")
+@login_required
+def admin_calendar_day(day):
+    """حجوزات يوم واحد (جزء HTML يُحمّل داخل التقويم)"""
+    admin_required()
+    try:
+        d = date.fromisoformat(day)
+    except ValueError:
+        abort(404)
+    start, end = day_bounds(d)
+    bookings = db.session.scalars(
+        db.select(Booking)
+        .options(selectinload(Booking.user), selectinload(Booking.service), selectinload(Booking.car_info))
+        .where(Booking.appointment_at >= start, Booking.appointment_at < end)
+        .order_by(Booking.appointment_at, Booking.id)
+    ).all()
+    archived = []
+    if request.args.get("archive") == "1":
+        archived = db.session.scalars(
+            db.select(ArchivedBooking)
+            .options(selectinload(ArchivedBooking.user), selectinload(ArchivedBooking.service),
+                     selectinload(ArchivedBooking.car_info))
+            .where(ArchivedBooking.appointment_at >= start, ArchivedBooking.appointment_at < end)
+            .order_by(ArchivedBooking.appointment_at, ArchivedBooking.id)
+        ).all()
+    return render_template("admin_calendar_day.html", day=d, bookings=bookings, archived=archived,
+                           day_name=WEEKDAY_NAMES[d.weekday()])
+
+@app.route("/admin/search")
+@login_required
+def admin_search():
+    """بحث موحد: العملاء بالاسم أو الجوال (user_search_term) أولاً، ثم الحجوزات باللوحة أو السيارة
+    أو الملاحظات مرتبة بالأهمية"""
+    admin_required()
+    q = request.args.get("q", "").strip()
+    hits = search_index.search(q) if q else []
+    ids = {kind: [ref for k, ref in hits if k == kind] for kind in SEARCH_KINDS}
+    users = db.session.scalars(
+        db.select(User).where(user_search_condition(q))
+        .order_by(User.bookings_count.desc(), User.id.desc()).limit(SEARCH_LIMIT)
+    ).all() if q else []
+    bookings = db.session.scalars(
+        db.select(Booking)
+        .options(selectinload(Booking.user), selectinload(Booking.service), selectinload(Booking.car_info))
+        .where(db.or_(Booking.id.in_(ids["booking"]), Booking.car_info_id.in_(ids["car"])))
+        .order_by(Booking.appointment_at.desc())
+    ).all() if ids["booking"] or ids["car"] else []
+    by_id = {b.id: b for b in bookings}
+    by_car = {}
+    for b in bookings:
+        by_car.setdefault(b.car_info_id, []).append(b)
+
+    # بترتيب الأهمية، مع تجاهل صفوف فهرس لكيانات حُذفت بعبارات جماعية
+    results, seen = [("user", u) for u in users], set()
+    for kind, ref in hits:
+        for b in ([by_id[ref]] if kind == "booking" and ref in by_id else by_car.get(ref, []) if kind == "car" else []):
+            if b.id not in seen:
+                seen.add(b.id)
+                results.append(("booking", b))
+    return render_template("admin_search.html", q=q, results=results)
+
+def report_range(args) -> tuple[str, date, date]:
+    """period و [from, to) من معاملات الطلب؛ الافتراضي آخر 30 يوماً/12 أسبوعاً/12 شهراً حتى اليوم"""
+    period = args.get("period", "day")
+    if period not in REPORT_PERIODS:
+        period = "day"
+    today = date.today()
+    try:
+        last = date.fromisoformat(args.get("to", "")) + timedelta(days=1)
+    except ValueError:
+        last = today + timedelta(days=1)
+    default_first = {
+        "day": last - timedelta(days=30),
+        "week": period_start(last - timedelta(weeks=12), "week"),
+        "month": period_start(last - timedelta(days=365), "month"),
+    }[period]
+    try:
+        first = date.fromisoformat(args.get("from", ""))
+    except ValueError:
+        first = default_first
+    if first >= last:
+        first = default_first
+    return period, first, last
+
+@app.route("/admin/reports")
+@login_required
+def admin_reports():
+    """ملخص اليوم/الأسبوع/الشهر ورسم الإيراد، كلها من booking_rollup"""
+    admin_required()
+    period, first, last = report_range(request.args)
+    today = date.today()
+    week = period_start(today, "week")
+    month = period_start(today, "month")
+    cards = [
+        ("اليوم", rollup_totals(today, today + timedelta(days=1))),
+        ("هذا الأسبوع", rollup_totals(week, week + timedelta(days=7))),
+        ("هذا الشهر", rollup_totals(month, (month + timedelta(days=32)).replace(day=1))),
+    ]
+    return render_template(
+        "admin_reports.html", cards=cards, period=period, first=first, last=last - timedelta(days=1),
+        totals=rollup_totals(first, last), currency_label=CURRENCY_LABEL,
+    )
+
+@app.route("/admin/reports/heatmap")
+@login_required
+def admin_report_heatmap():
+    """خريطة إشغال الغرف: يوم الأسبوع × موعد، لأي نطاق تواريخ (from/to)"""
+    admin_required()
+    _, first, last = report_range(request.args)
+    heatmap = utilization_heatmap(first, last)
+    return render_template("admin_heatmap.html", heatmap=heatmap, first=first, last=last - timedelta(days=1))
+
+@app.route("/admin/reports/cohorts")
+@login_required
+def admin_report_cohorts():
+    """أفواج العملاء بشهر التسجيل (from/to بصيغة YYYY-MM) ومسار خدمة أولى ← خدمة لاحقة"""
+    admin_required()
+    this_month = date.today().replace(day=1)
+
+    def month_arg(name, default):
+        try:
+            return date.fromisoformat(request.args.get(name, "") + "-01")
+        except ValueError:
+            return default
+
+    last = month_arg("to", this_month)
+    last = (last + timedelta(days=32)).replace(day=1)
+    first = month_arg("from", (last - timedelta(days=365)).replace(day=1))
+    if first >= last or (last.year - first.year) * 12 + last.month - first.month > 60:
+        first = (last - timedelta(days=365)).replace(day=1)
+    first_service = request.args.get("first_service", type=int)
+    then_service = request.args.get("then_service", type=int)
+    report = cohort_report.result(first, last, first_service, then_service)
+    services = db.session.execute(db.select(Service.id, Service.name).order_by(Service.name)).all()
+    return render_template(
+        "admin_cohorts.html", report=report, services=services, first=first,
+        last=(last - timedelta(days=1)).replace(day=1), first_service=first_service, then_service=then_service,
+    )
+
+@app.route("/admin/reports/series")
+@login_required
+def admin_report_series():
+    """سلسلة الحجوزات والإيراد كـ JSON للرسم: period=day|week|month&from&to&points"""
+    admin_required()
+    period, first, last = report_range(request.args)
+    points = min(request.args.get("points", REPORT_MAX_POINTS, type=int) or REPORT_MAX_POINTS, REPORT_MAX_POINTS)
+    return jsonify(
+        period=period, start=first.isoformat(), end=(last - timedelta(days=1)).isoformat(),
+        totals=rollup_totals(first, last), series=rollup_series(first, last, period, points),
+    )
+
 # ---------- Admin Services ----------
 @app.route("/admin/services")
 @login_required
 def admin_services():
     admin_required()
-    items = db.session.scalars(db.select(Service).order_by(Service.name)).all()
-    return render_template("admin_services.html", items=items)
+    page = keyset_page(
+        db.select(Service), [(Service.name, "asc"), (Service.id, "asc")],
+        after=request.args.get("after"), before=request.args.get("before"), per_page=ADMIN_PAGE_SIZE,
+    )
+    return render_template("admin_services.html", items=page.items, page=page)
 
 @app.route("/admin/services/new", methods=["GET","POST"])
 @login_required
@@ -1195,8 +3751,11 @@ def admin_service_delete(service_id):
 @login_required
 def admin_offers():
     admin_required()
-    items = db.session.scalars(db.select(Offer).order_by(Offer.id.desc())).all()
-    return render_template("admin_offers.html", items=items)
+    page = keyset_page(
+        db.select(Offer), [(Offer.id, "desc")],
+        after=request.args.get("after"), before=request.args.get("before"), per_page=ADMIN_PAGE_SIZE,
+    )
+    return render_template("admin_offers.html", items=page.items, page=page)
 
 # استبدل دالة admin_offer_new في app.py بهذا الكود:
 
@@ -1334,10 +3893,11 @@ def admin_offer_delete(offer_id):
 @login_required
 def admin_videos():
     admin_required()
-    items = db.session.scalars(
-        db.select(Video).order_by(Video.sort.asc(), Video.created_at.desc())
-    ).all()
-    return render_template("admin_videos.html", items=items)
+    page = keyset_page(
+        db.select(Video), VIDEO_ORDER,
+        after=request.args.get("after"), before=request.args.get("before"), per_page=ADMIN_PAGE_SIZE,
+    )
+    return render_template("admin_videos.html", items=page.items, page=page)
 
 @app.route("/admin/videos/new", methods=["GET","POST"])
 @login_required
@@ -1449,24 +4009,11 @@ def admin_video_delete(video_id):
 # ---------- Public Videos ----------
 @app.route("/videos")
 def videos_page():
-    page = request.args.get("page", 1, type=int)
-    per_page = 9
-
-    base_q = (
-        db.select(Video)
-          .where(Video.active == True)
-          .order_by(Video.sort.asc(), Video.created_at.desc())
+    page = keyset_page(
+        db.select(Video).where(Video.active == True), VIDEO_ORDER,
+        after=request.args.get("after"), before=request.args.get("before"), per_page=9,
     )
-    items = db.session.scalars(
-        base_q.limit(per_page).offset((page - 1) * per_page)
-    ).all()
-
-    total = db.session.scalar(
-        db.select(db.func.count()).select_from(Video).where(Video.active == True)
-    )
-    pages = (total + per_page - 1) // per_page if total else 1
-
-    return render_template("videos.html", items=items, page=page, pages=pages)
+    return render_template("videos.html", items=page.items, page=page)
 
 # ---------- Account ----------
 @app.route("/account/password", methods=["GET","POST"])
@@ -1498,6 +4045,7 @@ def admin_contact():
     if form.validate_on_submit():
         form.populate_obj(contact)
         db.session.commit()
+        _contact_cache.clear()
         flash("تم حفظ بيانات التواصل.", "success")
         return redirect(url_for("contact_page"))
     return render_template("admin_contact.html", form=form)
@@ -1510,6 +4058,8 @@ def init_db():
     """Initialize the database and seed default data."""
     db.drop_all()
     db.create_all()
+    search_index.ensure(reset=True)
+    ensure_user_search()
 
     admin_phone = os.environ.get("ADMIN_PHONE", "+966501234567")
     admin_password = os.environ.get("ADMIN_PASSWORD", "admin123")
@@ -1543,8 +4093,179 @@ def init_db():
 def upgrade_db():
     """Create any missing tables without dropping existing data."""
     db.create_all()
+    if ensure_service_popularity():
+        refresh_popularity()
+        print("📈 تم حساب شعبية الخدمات")
+    if ensure_price_history():
+        print(f"💰 تمت تعبئة سعر {backfill_booking_prices()} حجز من سجل الأسعار")
+    if ensure_user_activity():
+        refresh_user_activity(db.session.connection())
+        db.session.commit()
+        print("📊 تمت إضافة عدّادات الحجوزات للمستخدمين")
+    if ensure_rollups():
+        refresh_rollups(db.session.connection())
+        db.session.commit()
+        print("📊 تم بناء تجميعات التقارير")
+    if ensure_slot_holds():
+        print("🗓️ تمت ترقية slot_reservation للحجوزات المؤقتة وإعادة بناء خلاياه")
+    if search_index.ensure():
+        print(f"🔎 تمت فهرسة {search_index.rebuild()} سجل للبحث")
+    elif search_index.drop_kind("user"):
+        print("🔎 حُذفت صفوف العملاء من فهرس البحث (يُبحث عنهم في user_search_term)")
+    if ensure_user_search():
+        print(f"🔎 تم توليد كلمات البحث لـ {rebuild_user_search()} عميل")
     print("✅ DB upgraded (created missing tables).")
 
+@app.cli.command("rebuild-reservations")
+def rebuild_reservations():
+    """إعادة بناء خلايا slot_reservation للحجوزات النشطة القادمة (بعد ترقية أو تغيير الموارد)"""
+    db.create_all()
+    done, failed = rebuild_slot_reservations()
+    print(f"✅ تمت إعادة بناء خلايا {done} حجز")
+    if failed:
+        print(f"⚠️ حجوزات متعارضة لم تُحجز خلاياها: {failed}")
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    """إعادة بناء فهرس البحث النصي من الجداول"""
+    search_index.ensure()
+    if not search_index.enabled:
+        print("❌ فهرس البحث غير متاح على هذه القاعدة")
+        return
+    print(f"✅ تمت فهرسة {search_index.rebuild()} سجل")
+
+@app.cli.command("rebuild-user-activity")
+def rebuild_user_activity():
+    """إعادة حساب عدد الحجوزات وآخر حجز لكل المستخدمين بتحديث واحد"""
+    db.create_all()
+    ensure_user_activity()
+    refresh_user_activity(db.session.connection())
+    db.session.commit()
+    print("✅ تمت إعادة حساب عدّادات الحجوزات")
+
+@app.cli.command("reconcile-rollups")
+def reconcile_rollups():
+    """مطابقة تجميعات التقارير مع الحجوزات (ليلياً): إعادة البناء وطباعة عدد الصفوف التي اختلفت"""
+    db.create_all()
+    def snapshot():
+        return {
+            (r.day, r.service_id, r.status): (r.bookings, r.revenue, r.minutes)
+            for r in db.session.scalars(db.select(BookingRollup))
+        }
+    before = snapshot()
+    refresh_rollups(db.session.connection())
+    db.session.commit()
+    db.session.expunge_all()
+    after = snapshot()
+    drift = sum(1 for key in before.keys() | after.keys() if before.get(key) != after.get(key))
+    print(f"✅ تمت مطابقة {len(after)} صف تجميعي" + (f" (صُحّح {drift})" if drift else ""))
+
+@app.cli.command("refresh-popularity")
+def refresh_popularity_cmd():
+    """إعادة حساب شعبية الخدمات لترتيب الصفحة الرئيسية (دورياً عبر cron)"""
+    db.create_all()
+    ensure_service_popularity()
+    scores = refresh_popularity()
+    names = dict(db.session.execute(db.select(Service.id, Service.name)).all())
+    for sid, score in sorted(scores.items(), key=lambda kv: -kv[1]):
+        print(f"   - {names.get(sid, sid)}: {score}")
+    print(f"✅ تم تحديث شعبية {len(names)} خدمة")
+
+@app.cli.command("rebuild-user-search")
+def rebuild_user_search_cmd():
+    """إعادة توليد كلمات البحث المطبّعة للعملاء (بعد تعديل قواعد التطبيع)"""
+    db.create_all()
+    ensure_user_search()
+    print(f"✅ تم توليد كلمات البحث لـ {rebuild_user_search()} عميل")
+
+@app.cli.command("archive-bookings")
+@click.option("--days", type=int, default=ARCHIVE_AFTER_DAYS, show_default=True, help="أرشفة ما هو أقدم من هذا العدد من الأيام")
+@click.option("--batch", type=int, default=ARCHIVE_BATCH, show_default=True, help="عدد الحجوزات في كل دفعة")
+def archive_bookings(days, batch):
+    """نقل الحجوزات القديمة ومعلومات سياراتها إلى جداول الأرشيف على دفعات (معاملة لكل دفعة)"""
+    db.create_all()
+    cutoff = datetime.combine(date.today() - timedelta(days=days), dtime.min)
+    # الأعمدة المنسوخة هي المشتركة بين الجدول الحي وجدول أرشيفه، فيتبع النسخ أي عمود يُضاف للاثنين
+    booking_cols = [c.name for c in Booking.__table__.columns if c.name in ArchivedBooking.__table__.columns]
+    car_cols = [c.name for c in CarInfo.__table__.columns if c.name in ArchivedCarInfo.__table__.columns]
+    moved = 0
+    while True:
+        ids = db.session.scalars(
+            db.select(Booking.id).where(Booking.appointment_at < cutoff).order_by(Booking.id).limit(batch)
+        ).all()
+        if not ids:
+            break
+        # سيارات الدفعة التي لا يشير إليها حجز حي آخر
+        car_ids = set(db.session.scalars(
+            db.select(Booking.car_info_id).where(Booking.id.in_(ids), Booking.car_info_id.is_not(None))
+        ))
+        car_ids = list(car_ids - set(db.session.scalars(
+            db.select(Booking.car_info_id).where(Booking.car_info_id.in_(car_ids), Booking.id.not_in(ids))
+        )))
+
+        db.session.execute(
+            db.insert(ArchivedCarInfo).from_select(
+                car_cols, db.select(*(CarInfo.__table__.c[c] for c in car_cols)).where(CarInfo.id.in_(car_ids))
+            )
+        )
+        db.session.execute(
+            db.insert(ArchivedBooking).from_select(
+                booking_cols, db.select(*(Booking.__table__.c[c] for c in booking_cols)).where(Booking.id.in_(ids))
+            )
+        )
+        # حجوزات أُبقيت سيارتها في car_info (مشتركة مع حجز حي) تفقد الربط في الأرشيف
+        db.session.execute(
+            db.update(ArchivedBooking)
+            .where(ArchivedBooking.id.in_(ids), ArchivedBooking.car_info_id.not_in(car_ids))
+            .values(car_info_id=None)
+        )
+        db.session.execute(db.delete(SlotReservation).where(SlotReservation.booking_id.in_(ids)))
+        db.session.execute(db.delete(Booking).where(Booking.id.in_(ids)))
+        db.session.execute(db.delete(CarInfo).where(CarInfo.id.in_(car_ids)))
+        search_index.forget(db.session.connection(), "booking", ids)
+        search_index.forget(db.session.connection(), "car", car_ids)
+        db.session.commit()
+        moved += len(ids)
+        print(f"… {moved} حجز")
+    print(f"✅ تمت أرشفة {moved} حجز أقدم من {cutoff.date()}")
+
+@app.cli.command("add-resource")
+@click.argument("name")
+@click.option("--kind", type=click.Choice(list(RESOURCE_KINDS)), default="bay", show_default=True)
+def add_resource(name, kind):
+    """إضافة مورد تشغيلي (غرفة عمل أو فنّي)"""
+    db.session.add(Resource(name=name, kind=kind, active=True))
+    db.session.commit()
+    total = db.session.scalar(
+        db.select(db.func.count(Resource.id)).where(Resource.kind == kind, Resource.active == True)
+    )
+    print(f"✅ تمت إضافة {RESOURCE_KINDS[kind]}: {name} (المجموع: {total})")
+
+@app.cli.command("set-requirement")
+@click.argument("service_id", type=int)
+@click.argument("kind", type=click.Choice(list(RESOURCE_KINDS)))
+@click.argument("quantity", type=int)
+def set_requirement(service_id, kind, quantity):
+    """تحديد ما تحتاجه الخدمة من نوع مورد (الكمية 0 تحذف المتطلب)"""
+    service = db.session.get(Service, service_id)
+    if not service:
+        print(f"❌ لا توجد خدمة برقم {service_id}")
+        return
+    req = db.session.scalar(
+        db.select(ServiceRequirement).where(
+            ServiceRequirement.service_id == service_id, ServiceRequirement.kind == kind
+        )
+    )
+    if quantity <= 0:
+        if req:
+            db.session.delete(req)
+    elif req:
+        req.quantity = quantity
+    else:
+        db.session.add(ServiceRequirement(service_id=service_id, kind=kind, quantity=quantity))
+    db.session.commit()
+    print(f"✅ {service.name}: {RESOURCE_KINDS[kind]} × {max(quantity, 0)}")
+
 # =========================================
 # Main
 # =========================================
@@ -1600,11 +4321,16 @@ def show_offers():
     except Exception as e:
         print(f"❌ خطأ: {e}")
 # إنشاء الجداول عند بدء التطبيق
+# ترقية قاعدة قديمة (أعمدة وفهارس وتعبئة بيانات) في flask upgrade-db فقط، لا عند كل تشغيل؛
+# هنا لا يُقرأ إلا أعمدة أصلية حتى يعمل التشغيل (و upgrade-db نفسه) على قاعدة لم تُرقَّ بعد
 with app.app_context():
     db.create_all()
+    # فهرس البحث يُنشأ هنا فقط إن لم يكن فيه ما يُفهرس، وإلا ينشئه ويعبّئه upgrade-db
+    nothing_to_index = all(db.session.scalar(db.select(model.id).limit(1)) is None for model in SearchIndex.KIND_OF)
+    search_index.ensure(create=nothing_to_index)
     
     # إضافة بيانات أولية إذا لم تكن موجودة
-    if not db.session.scalar(db.select(User).where(User.is_admin == True)):
+    if not db.session.scalar(db.select(User.id).where(User.is_admin == True)):
         # إنشاء مدير افتراضي
         admin = User(
             full_name="المدير الرئيسي",
@@ -0,0 +1,141 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+
+import pytest
+
+import app as m
+
+
+@pytest.fixture()
+def ctx():
+    with m.app.app_context():
+        user = m.User(full_name="اختبار", phone="0500000001", password_hash="x")
+        service = m.Service(name="تلميع", price=100, duration_minutes=90)
+        short = m.Service(name="غسيل", price=30, duration_minutes=30)
+        m.db.session.add_all([user, service, short, m.Resource(name="غرفة 1"), m.Resource(name="غرفة 2")])
+        m.db.session.flush()
+        m.db.session.add_all([
+            m.ServiceRequirement(service_id=service.id, kind="bay", quantity=1),
+            m.ServiceRequirement(service_id=short.id, kind="bay", quantity=1),
+        ])
+        m.db.session.commit()
+        m.slot_index.invalidate()
+        yield user, service, short
+        m.db.session.rollback()
+        for model in (m.SlotReservation, m.SlotHold, m.Booking, m.ServiceRequirement, m.Resource,
+                      m.ServicePrice, m.Service):
+            m.db.session.execute(m.db.delete(model))
+        m.db.session.execute(m.db.delete(m.User).where(m.User.id >= user.id))
+        m.db.session.commit()
+        m.slot_index.invalidate()
+
+
+def _book(user, service, at):
+    booking = m.Booking(user_id=user.id, service_id=service.id, appointment_at=at, status="pending")
+    m.db.session.add(booking)
+    m.db.session.flush()
+    return booking
+
+
+def _day():
+    return (datetime.now() + timedelta(days=7)).replace(hour=13, minute=0, second=0, microsecond=0)
+
+
+@contextmanager
+def _request():
+    """طلب مستقل بسياق تطبيق و g جديدين كما في عامل gunicorn"""
+    with m.app.app_context(), m.app.test_request_context():
+        yield
+
+
+def _other_process(*statements):
+    """تعديل من عملية أخرى: اتصال منفصل لا تصل منه invalidate() إلى ذاكرة هذه العملية"""
+    with m.db.engine.begin() as conn:
+        for statement in statements:
+            conn.execute(statement)
+
+
+def test_fragmented_capacity_fits(ctx):
+    user, service, short = ctx
+    at = _day()
+    # وحدتان مشغولتان في خلايا مختلفة: الغرفة 0 عند 13:00 والغرفة 1 عند 14:00
+    first, second = _book(user, short, at), _book(user, short, at + timedelta(hours=1))
+    m.db.session.add_all([
+        m.SlotReservation(booking_id=first.id, lane="bay", unit=0, slot_at=at, slot_end=at + timedelta(minutes=30)),
+        m.SlotReservation(booking_id=second.id, lane="bay", unit=1,
+                          slot_at=at + timedelta(hours=1), slot_end=at + timedelta(minutes=90)),
+    ])
+    m.db.session.flush()
+
+    # 13:00-14:30 لا تتسع لها وحدة واحدة طوال المدة لكن كل خلية فيها وحدة حرة
+    assert m.reserve_slot(_book(user, service, at))
+    counts = m.db.session.execute(
+        m.db.select(m.SlotReservation.slot_at, m.db.func.count())
+        .where(m.SlotReservation.lane == "bay").group_by(m.SlotReservation.slot_at)
+    ).all()
+    assert all(n <= 2 for _, n in counts)
+
+
+def test_full_cell_rejected(ctx):
+    user, service, short = ctx
+    at = _day()
+    assert m.reserve_slot(_book(user, short, at + timedelta(minutes=30)))
+    assert m.reserve_slot(_book(user, short, at + timedelta(minutes=30)))
+    assert not m.reserve_slot(_book(user, service, at))
+
+
+def test_worker_reloads_changed_catalog(ctx):
+    user, service, short = ctx
+    worker = m.SlotIndex()  # نسخة عامل آخر؛ invalidate() هنا لا يصلها
+    with _request():
+        assert worker.duration(short.id) == 30
+        assert worker.lane_capacity("bay") == 2
+    short.duration_minutes = 120
+    m.db.session.add(m.Resource(name="غرفة 3"))
+    m.db.session.commit()
+    with _request():
+        assert worker.duration(short.id) == 120
+        assert worker.lane_capacity("bay") == 3
+
+
+def test_claim_uses_current_duration(ctx):
+    user, service, short = ctx
+    at = _day()
+    assert m.slot_index.duration(short.id) == 30
+    _other_process(
+        m.db.update(m.Service).where(m.Service.id == short.id).values(duration_minutes=60),
+        m.db.update(m.CatalogVersion).values(version=m.CatalogVersion.version + 1),
+    )
+    booking = _book(user, short, at)
+    assert m.reserve_slot(booking)
+    cells = m.db.session.scalar(
+        m.db.select(m.db.func.count()).where(m.SlotReservation.booking_id == booking.id)
+    )
+    assert cells == 60 // m.business_calendar.step
+
+
+def test_price_snapshot_after_price_change(ctx):
+    user, service, short = ctx
+    assert m.price_book.price_at(service.id, datetime.now()) == 100
+    _other_process(m.db.update(m.Service).where(m.Service.id == service.id).values(price=150))
+    assert _book(user, service, _day()).price == 150
+
+
+def test_active_hold_blocks_booking(ctx):
+    user, service, short = ctx
+    other = m.User(full_name="آخر", phone="0500000002", password_hash="x")
+    m.db.session.add(other)
+    m.db.session.commit()
+    at = _day()
+    assert m.reserve_slot(_book(user, short, at))
+    assert m.hold_store.place(other.id, short.id, at)  # الغرفة الثانية محجوزة مؤقتاً
+    assert not m.reserve_slot(_book(user, short, at))
+
+    # بعد انتهاء الحجز المؤقت تُعد خلاياه قديمة وتُحذف عند المطالبة
+    m.db.session.execute(m.db.update(m.SlotHold).values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+    assert m.reserve_slot(_book(user, short, at))